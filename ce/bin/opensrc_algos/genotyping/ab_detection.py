@@ -121,7 +121,8 @@ def presence_detector(sequence_database, query_path, cached_query, percent_ident
     # Eliminate any overlap between genotypes of different references
     # and return the accepted genotypes
     log_message('Determining optimal genotype(s)', 2)
-    accepted = eliminate_overlap(regions, min_merge_overlap)
+    accepted = eliminate_overlap(regions, min_merge_overlap,
+        tie_break=sequence_database.dedupe)
 
     log_message('After overlap analysis, {} genotypes were retained!'.format(
         len(accepted)))
@@ -509,7 +510,7 @@ def encompassed(hit1, hit2, min_coverage):
     return total_overlap >= min_coverage * min(
         hit1_length, hit2_length)
 
-def eliminate_overlap(regions, min_merge_overlap):
+def eliminate_overlap(regions, min_merge_overlap, tie_break=False):
 
     # Create a flat list of all of the hits
     regions = [hit for region in regions.itervalues() for \
@@ -551,8 +552,15 @@ def eliminate_overlap(regions, min_merge_overlap):
         # childrens list
         hits_here = list(children)
 
-        # Sort the regions based on identity:
-        hits_here.sort(key=lambda x: -regions[x].identity)
+        # Sort the regions based on identity. With tie_break, ties go
+        # to the smallest reference id so that which one is kept
+        # doesn't depend on the order the hits came in
+        if tie_break:
+            hits_here.sort(key=lambda x: (-regions[x].identity,
+                regions[x].locations[0].reference_id))
+
+        else:
+            hits_here.sort(key=lambda x: -regions[x].identity)
 
         # Get rid of all the worst ones:
         to_remove.extend(hits_here[1:])
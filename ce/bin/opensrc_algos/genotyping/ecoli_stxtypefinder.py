@@ -33,13 +33,16 @@ from .rb_detection import (
 )
 
 from tools.bowtie import (
-    bowtie_index,
-    paired_bowtie2,
+    cached_bowtie_index,
+)
+
+from tools.reads import (
+    kmer_prefilter,
+    target_coverage_reads
 )
 
 from tools.samtools import (
-    sam_view,
-    bam_sort,
+    paired_bowtie2_sorted,
     pile_up_sam
 )
 
@@ -75,29 +78,38 @@ def prepare_pileup(settings, env, dbinfo):
 
     log_message('Indexing reference files...')
 
-    index_file = bowtie_index(out_file, env)
+    # The index only changes when the references do
+    index_file = cached_bowtie_index(out_file, env)
 
     log_message('Success!')
 
-    log_message('Mapping reads against references...')
+    # Deep runs don't call anything more than a subsample would
+    query_reads = target_coverage_reads(settings, env)
 
-    sam_file = paired_bowtie2(settings.query_reads, env, index_path=index_file)
+    # Almost none of the reads come from the stx genes, so
+    # only hand bowtie2 the pairs that might map
+    if settings['kmer_prefilter']:
 
-    log_message('Success!')
+        log_message('Screening reads for stx k-mers...')
 
-    log_message('Sorting sam file and creating pileup...')
+        query_reads = kmer_prefilter(
+            query_reads,
+            out_file,
+            os.path.join(env.localdir, 'prefilter'),
+            k=settings['prefilter_k'] or 21,
+            step=settings['prefilter_step'] or 5
+        )
 
-    bam_path = sam_view(
-        sam_file,
-        env,
-        # Output to bam
-        '-b',
+        log_message('Success!')
 
-        # Input is SAM format
-        '-S'
-    )
+    log_message('Mapping reads against references...')
+
+    # Mapping, conversion and sorting all happen in one pipeline
+    bam_sorted = paired_bowtie2_sorted(query_reads, env, index_path=index_file)
 
-    bam_sorted = bam_sort(bam_path, env)
+    log_message('Success!')
+
+    log_message('Creating pileup...')
 
     pileup_path = pile_up_sam(bam_sorted, out_file, env)
 
@@ -105,6 +117,18 @@ def prepare_pileup(settings, env, dbinfo):
 
     return pileup_path
 
+def reads_panel(settings, env, out_file):
+    # The references to map the reads against when the
+    # reads are mapped for all genotypers at once
+    sequence_database = DbInfo(
+        env.get_sharedpath(settings.database),
+        seq_parser = sequence_parser,
+        cache_dir = env.cachedir,
+        lazy = bool(settings['lazy_database'])
+    )
+
+    sequence_database.export_sequences(out_file)
+
 def main(settings, env):
     
     log_message('Beginning reads based STX detection algorithm')
@@ -133,17 +157,29 @@ def main(settings, env):
         ' information')
 
     sequence_database = DbInfo(
-        database_path, seq_parser = sequence_parser)
+        database_path,
+        seq_parser = sequence_parser,
+        cache_dir = env.cachedir,
+        lazy = bool(settings['lazy_database'])
+    )
 
     log_message('Succesfully loaded sequences and metadata')
-    log_message('Indexing references and executing mapping')
 
-    pileup_path = prepare_pileup(settings, env, sequence_database)
+    # The reads might already have been mapped along
+    # with the other reads based genotypers
+    if settings['reads_pileup']:
+        log_message('Using shared mapping of reads')
+        pileup_path = settings['reads_pileup']
+
+    else:
+        log_message('Indexing references and executing mapping')
+        pileup_path = prepare_pileup(settings, env, sequence_database)
 
     log_message('Searching alignments for stx subtypes')
 
     found_sequences = build_sequences(
-        pileup_path, settings.min_ambiguity, settings.min_coverage, settings.max_complexity)
+        pileup_path, settings.min_ambiguity, settings.min_coverage, settings.max_complexity,
+        vectorized=bool(settings['vectorized_consensus']))
 
     results_out = sequence_database.results_parser(found_sequences, f=results_parser)
 
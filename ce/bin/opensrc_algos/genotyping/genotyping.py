@@ -41,6 +41,10 @@ from tools.environment import (
 from tools.config import Config
 from tools.custom_parser import CustomParser
 
+from .rb_mapping import (
+    shared_pileups
+)
+
 def parse_settings(args, remaining):
 
     parser = argparse.ArgumentParser()
@@ -97,29 +101,74 @@ def run_genotyper(module_name, settings, env):
     except:
         log_exception('Error running genotyper: {}'.format(module_name))
 
-def setup_genotyper(genotyper, module_name, organism_config, env, data):
-
-    # Check to make sure we actually got a module name
-    if module_name is None:
-        raise RuntimeError('Requested module does not'
-            ' exist. This should not have occurred')
+def genotyper_settings(genotyper, organism_config, data):
 
     # Get the settings of the genotyper
-    genotyper_settings = organism_config.genotypers[genotyper]
+    settings = organism_config.genotypers[genotyper]
 
     # Merge the custom args with the client requested arguments
-    CustomParser.update(genotyper, genotyper_settings)
+    CustomParser.update(genotyper, settings)
 
     # Add the query path to the settings
-    genotyper_settings.query = data.get('query', None)
+    settings.query = data.get('query', None)
 
     # Add the reads to the query genotyper
-    genotyper_settings.query_reads = data.get('query_reads', [])
+    settings.query_reads = data.get('query_reads', [])
 
     # Add the cached_query to the settings
-    genotyper_settings.cached_query = data.get('cached_query', None)
+    settings.cached_query = data.get('cached_query', None)
+
+    return settings
+
+def setup_genotyper(genotyper, module_name, settings, env):
+
+    # Check to make sure we actually got a module name
+    if module_name is None:
+        raise RuntimeError('Requested module does not'
+            ' exist. This should not have occurred')
+
+    run_genotyper(module_name, settings, env)
+
+def map_reads(genotypers, global_config, all_settings, env, data):
+
+    # Reads based genotypers that provide a reads_panel function
+    # get their reads mapped all at once
+    panels = []
+
+    for genotyper in genotypers:
+
+        module_name = global_config['modules'][genotyper]
+
+        if module_name is None:
+            continue
+
+        module = importlib.import_module('genotyping.' + module_name)
+
+        if hasattr(module, 'reads_panel'):
+            panels.append((genotyper, module, all_settings[genotyper]))
 
-    run_genotyper(module_name, genotyper_settings, env)
+    if not panels or len(data.get('query_reads', [])) < 2:
+        return
+
+    log_message('Mapping reads for: {}'.format(
+        ', '.join(genotyper for genotyper, _, _ in panels)))
+
+    mapping_env = env.copy()
+    mapping_env.localdir = os.path.join(
+        mapping_env.localdir, 'genotyping.rb_mapping')
+
+    set_base_depth(-(get_stack_len()))
+
+    try:
+        pileups = shared_pileups(panels, mapping_env)
+
+    except:
+        # Each of them can still map the reads on its own
+        log_exception('Error mapping reads')
+        return
+
+    for genotyper, _, settings in panels:
+        settings.reads_pileup = pileups[genotyper]
 
 def main(args, remaining, env, module_settings):
 
@@ -159,7 +208,16 @@ def main(args, remaining, env, module_settings):
     # Just so that logging is nice in this section
     set_base_depth(-(get_stack_len()))
 
-    query_filename, cached_query = process_seq_file(query_filename, load=True)
+    # Large queries can be read from disk as needed
+    # or packed instead of being held in memory. Indexed
+    # queries are shared with any worker processes
+    query_filename, cached_query = process_seq_file(
+        query_filename,
+        load=True,
+        indexed=bool(global_config['indexed_query']),
+        packed=bool(global_config['packed_query']),
+        store_dir=os.path.join(env.tempdir, 'store')
+    )
 
     log_message('Checking read files...', extra=-1)
     
@@ -208,6 +266,28 @@ def main(args, remaining, env, module_settings):
         'cached_query' : cached_query
     }
 
+    # Get the modules that we always need to run no matter what
+    always_run = organism_config.always_run
+
+    # Every genotyper gets its settings set up once,
+    # before anything runs
+    all_settings = {}
+
+    for genotyper in genotypers_to_run + list(always_run):
+
+        if genotyper not in all_settings:
+            all_settings[genotyper] = genotyper_settings(
+                genotyper, organism_config, data)
+
+    # The reads based genotypers share one mapping of the reads
+    map_reads(
+        sorted(all_settings),
+        global_config,
+        all_settings,
+        env,
+        data
+    )
+
     for genotyper in genotypers_to_run:
 
         # Get the actual file name of the module
@@ -216,14 +296,10 @@ def main(args, remaining, env, module_settings):
         setup_genotyper(
             genotyper,
             module_name,
-            organism_config,
-            env,
-            data
+            all_settings[genotyper],
+            env
         )
 
-    # Get the modules that we always need to run no matter what
-    always_run = organism_config.always_run
-
     for genotyper in always_run:
 
         module_name = global_config['modules'][genotyper]
@@ -231,7 +307,6 @@ def main(args, remaining, env, module_settings):
         setup_genotyper(
             genotyper,
             module_name,
-            organism_config,
-            env,
-            data
-        )
\ No newline at end of file
+            all_settings[genotyper],
+            env
+        )
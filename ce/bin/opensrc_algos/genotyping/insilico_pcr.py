@@ -25,22 +25,22 @@ from tools.dbinfo import (
 from tools.tools import (
     is_fasta,
     parse_fasta,
-    check_mismatches,
+    count_mismatches,
     reverse_complement
 )
 
 from tools.align import (
-    BLASTSettings,
-    align_blast,
-    align_blast_nodb,
-    GenotypeHit,
-    create_blastdb
+    GenotypeHit
+)
+
+from .primer_search import (
+    search_primers
 )
 
 import os
 import json
 from functools import partial
-from itertools import combinations
+from itertools import izip
 from collections import namedtuple, defaultdict
 
 PcrTarget = namedtuple('PcrTarget', [
@@ -53,6 +53,41 @@ PcrTarget = namedtuple('PcrTarget', [
     'length'
 ])
 
+# blastn-short scores, what decided how much of
+# the primer BLAST aligned
+_MATCH_SCORE = 1
+_MISMATCH_SCORE = -3
+
+def local_identity(query_seq, primer):
+    """
+    The best scoring ungapped stretch of the primer against the query,
+    the way BLAST would have aligned it. Only the same letter counts as
+    identical there, IUPAC codes included. Returns the identical
+    positions and the length of the stretch, (0, 0) if nothing does
+    """
+
+    best = (0, 0, 0)
+    score = identical = aligned = 0
+
+    for nuc1, nuc2 in izip(query_seq.upper(), primer.upper()):
+
+        if score <= 0:
+            score = identical = aligned = 0
+
+        aligned += 1
+
+        if nuc1 == nuc2:
+            score += _MATCH_SCORE
+            identical += 1
+
+        else:
+            score += _MISMATCH_SCORE
+
+        if score > best[0]:
+            best = (score, identical, aligned)
+
+    return best[1], best[2]
+
 def sequence_parser(line):
     parts = line.split('\t')
 
@@ -100,58 +135,26 @@ def main(settings, env):
         ' information')
 
     sequence_database = DbInfo(
-        database_path, seq_parser = sequence_parser)
+        database_path,
+        seq_parser = sequence_parser,
+        cache_dir = env.cachedir
+    )
 
     log_message('Successfully loaded PCR targets and associated'
         ' information')
 
     log_message('Running insilico PCR...')
 
-    log_message('Exporting PCR target database...')
-
-    # Make the path
-    reference_dir = os.path.join(env.localdir, 'blastdb')
-    
-    # Check to make sure that its a real dir
-    valid_dir(reference_dir)
-
-    reference_path = os.path.join(reference_dir, 'references.fasta')
+    log_message('Searching query genome for PCR primers')
 
-    # Export the reference sequences for blast database creation
-    sequence_database.export_sequences(reference_path)
-
-    log_message('Successfully exported reference database...')
-    
-    # Create the path to the blast database
-    blast_db_path = os.path.join(env.localdir, 'blastdb', 'db.fasta')
-
-    log_message('Creating blast database...')
-
-    # Create the blast database
-    create_blastdb(reference_path, blast_db_path, env)
-    
-    # Log that we were successful
-    log_message('Successfully created blast database!')   
-
-    blast_settings = BLASTSettings(
-        task = 'blastn-short',
-        identity = settings.percent_identity,
-        relative_minlen = 0,
-        absolute_minlen = 0,
-        include_sequences = True
-    )
-
-    log_message('BLASTing query genome against PCR targets')
-
-    # Run the alignment
-    results = align_blast(
-        settings.query,
-        blast_db_path,
-        blast_settings,
-        env
+    # The primers are matched directly against the query
+    results = search_primers(
+        sequence_database.sequences,
+        settings.cached_query,
+        settings.max_mismatches
     )
 
-    log_message('Successfully BLASTed query genome against PCR targets')
+    log_message('Successfully searched query genome for PCR primers')
 
     log_message('Searching for ideal primer pairs...')
 
@@ -182,6 +185,10 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
     
     regions = defaultdict(list)
 
+    # The hits that are kept, mismatches are counted
+    # for all of them at once
+    kept_hits = []
+
     for hit in blast_results.hits:
 
         # Filter the hits that have more than zero insertions/deletions
@@ -213,12 +220,6 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
 
             hit.reference_seq = real_reference_seq
 
-            hit.num_mismatches = check_mismatches(
-                hit.query_seq, hit.reference_seq)
-
-            hit.identity = 1.0 - \
-                (float(hit.num_mismatches) / float(hit.reference_len))
-
         else:
 
             hit.query_start = hit.query_start - \
@@ -239,12 +240,6 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
             hit.reference_stop = hit.reference_len - 1
             hit.reference_seq = real_reference_seq
 
-            hit.num_mismatches = check_mismatches(
-                hit.query_seq, hit.reference_seq)
-
-            hit.identity = 1.0 - \
-                (float(hit.num_mismatches) / float(hit.reference_len))
-
         # We exported the reference database as a string of
         # primerid&fwdid/revid
         primer_id = hit.reference_id.split('&')[0]
@@ -252,6 +247,17 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
         # If the primer pairs exist, they should be part of the same
         # region
         regions[primer_id].append(hit)
+        kept_hits.append(hit)
+
+    mismatches = count_mismatches(
+        [(hit.query_seq, hit.reference_seq) for hit in kept_hits])
+
+    for hit, num_mismatches in izip(kept_hits, mismatches):
+
+        hit.num_mismatches = num_mismatches
+
+        hit.identity = 1.0 - \
+            (float(hit.num_mismatches) / float(hit.reference_len))
 
     log_message('Found {} potential primer pair regions'.format(
         len(regions)))
@@ -292,6 +298,16 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
                 to_remove.append(i)
                 continue
 
+            # The identity cutoff BLAST used to apply, in whole percent
+            # like it took it, over the part of the primer it aligned
+            identical, aligned = local_identity(
+                hit.query_seq, hit.reference_seq)
+
+            if not aligned or \
+                100 * identical < int(100.0 * percent_identity) * aligned:
+                to_remove.append(i)
+                continue
+
         # remove the poor quality hits
         for i in reversed(to_remove):
             del hits[i]
@@ -312,29 +328,20 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
 
         target_info = sequence_database.targets[target]
 
-        for hit1, hit2 in combinations(best_hits, 2):
+        target_length = float(target_info.length)
 
-            # The two hits should be on the same contig
-            if hit1.query_id != hit2.query_id:
-                continue
+        for i, j in primer_pairs(best_hits,
+            (1.0 - max_length_deviation) * target_length,
+            (1.0 + max_length_deviation) * target_length):
 
-            # These should be different from one another
-            if hit1.forward == hit2.forward:
-                continue
+            hit1 = best_hits[i]
+            hit2 = best_hits[j]
 
             # Get the length of the PCR product
             start = min(hit1.query_start, hit2.query_start)
             stop = max(hit1.query_stop, hit2.query_stop)
 
             length =  float(stop - start + 1)
-            target_length = float(target_info.length)
-
-            # If the length of the amplicon is not within (+/-)
-            # of the deviation, continue
-            if not (1.0 - max_length_deviation) * target_length <= length <= \
-                (1.0 + max_length_deviation) * target_length:
-
-                continue
 
             contig = cached_query.get(hit1.query_id, '')
 
@@ -378,6 +385,59 @@ def find_targets(sequence_database, cached_query, blast_results, max_mismatches,
 
     return final_results
 
+def primer_pairs(hits, min_length, max_length):
+    """
+    The pairs of hits (as indices, i < j) that are on the same contig,
+    on opposite strands, and make a product between min_length and
+    max_length long. The hits are bucketed by contig and strand and
+    sorted by where they start, a pair can't start further than
+    max_length apart so each hit is only compared to a window of
+    the hits on the other strand. In the same order as combinations()
+    """
+
+    buckets = defaultdict(lambda: ([], []))
+
+    for i, hit in enumerate(hits):
+        buckets[hit.query_id][hit.forward].append(i)
+
+    pairs = []
+
+    for reverse, forward in buckets.itervalues():
+
+        if not reverse or not forward:
+            continue
+
+        forward.sort(key=lambda i: hits[i].query_start)
+        reverse.sort(key=lambda i: hits[i].query_start)
+
+        lo = 0
+        hi = 0
+
+        for i in forward:
+
+            start = hits[i].query_start
+
+            # The window of reverse hits starting within max_length
+            while lo < len(reverse) and \
+                hits[reverse[lo]].query_start <= start - max_length:
+                lo += 1
+
+            while hi < len(reverse) and \
+                hits[reverse[hi]].query_start < start + max_length:
+                hi += 1
+
+            for j in reverse[lo:hi]:
+
+                length = max(hits[i].query_stop, hits[j].query_stop) - \
+                    min(start, hits[j].query_start) + 1
+
+                if min_length <= length <= max_length:
+                    pairs.append((min(i, j), max(i, j)))
+
+    pairs.sort()
+
+    return pairs
+
 class DbInfo(DbInfo):
 
     @property
@@ -26,8 +26,7 @@ from tools.dbinfo import (
 )
 
 from tools.tools import (
-    is_fasta,
-    parse_fasta
+    is_fasta
 )
 
 from .ab_detection import (
@@ -87,10 +86,11 @@ def main(settings, env):
         ' information')
 
     sequence_database = DbInfo(
-        database_path, seq_parser = sequence_parser)
-
-    # Load the mutation targets
-    sequence_database.load_extras()
+        database_path,
+        seq_parser = sequence_parser,
+        cache_dir = env.cachedir,
+        lazy = bool(settings['lazy_database'])
+    )
 
     log_message('Successfully loaded sequences and metadata!')
     log_message('Running mutation finder pipeline...')
@@ -134,7 +134,7 @@ class DbInfo(DbInfo):
                 continue
 
             # Load the sequences themselves from the files
-            sequences = parse_fasta(file_path)
+            sequences = self.load_sequences(file_path)
 
             for seq_id, sequence in sequences.iteritems():
                 # Create a named tuple that contains the 
@@ -162,6 +162,9 @@ class DbInfo(DbInfo):
 
                     self._notes[notes_info.locus] = notes_info
 
+        # Load the mutation targets
+        self.load_extras()
+
     def load_extras(self):
 
         self._targets = defaultdict(list)
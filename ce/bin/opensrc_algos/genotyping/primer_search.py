@@ -0,0 +1,387 @@
+###################################################################
+#
+# Finds the primers of the insilico PCR targets in the query
+# without BLAST
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import re
+
+from collections import namedtuple, defaultdict
+from itertools import product, izip, islice
+
+from tools.environment import (
+    log_message
+)
+
+from tools.tools import (
+    _NUC_SIBLINGS,
+    count_mismatches,
+    reverse_complement
+)
+
+from tools.align import (
+    GenotypeHit
+)
+
+# Same as the results of align_blast, a list of GenotypeHit
+PrimerResults = namedtuple('PrimerResults', ['hits'])
+
+# Where a seed sits: the primer it belongs to, the strand of the
+# query the primer is on and its offset within the primer
+# as it reads on the forward strand
+SeedSite = namedtuple('SeedSite', ['primer_id', 'forward', 'offset'])
+
+# Candidate sites are checked this many at a time
+_VERIFY_CHUNK = 1 << 16
+
+# Longest seed the packed k-mers take, longer pieces
+# are seeded with their start
+_MAX_SEED = 32
+
+# Runs of anything the seeds can't match, N, IUPAC codes
+_AMBIGUOUS = re.compile('[^ACGT]+')
+
+# Primers with more seeds than this once the IUPAC
+# codes are expanded are checked everywhere instead
+_MAX_EXPANSION = 1 << 14
+
+def expand_iupac(sequence):
+    # Every plain sequence the IUPAC sequence stands for
+    return [''.join(bases) for bases in product(
+        *[sorted(_NUC_SIBLINGS[nuc]) for nuc in sequence])]
+
+def expansion_size(sequence):
+    size = 1
+
+    for nuc in sequence:
+        size *= len(_NUC_SIBLINGS[nuc])
+
+    return size
+
+def piece_seeds(primer, pieces):
+    """
+    Cuts the primer (and its reverse complement) into pieces, a match
+    with fewer mismatches than pieces has at least one of them exactly.
+    The start of each piece, k long, is its seed. Returns k and a list
+    of (forward, offset, seed), None if the seeds can't be used: a piece
+    with something that isn't an IUPAC code, or so short or degenerate
+    that the seeds would turn up more often than there are places
+    to check
+    """
+
+    step = len(primer) // pieces
+    k = min(step, _MAX_SEED)
+
+    if not k:
+        return None
+
+    seeds = []
+    expansions = 0
+
+    for forward, oriented in ((True, primer),
+        (False, reverse_complement(primer))):
+
+        for offset in xrange(0, pieces * step, step):
+
+            seed = oriented[offset:offset+k].upper()
+
+            if any(nuc not in _NUC_SIBLINGS for nuc in seed):
+                return None
+
+            expansions += expansion_size(seed)
+            seeds.append((forward, offset, seed))
+
+    # A seed turns up about once every 4^k bases, checking both
+    # strands at every position is 2 sites per base
+    if expansions >= 2 * 4 ** k or expansions > _MAX_EXPANSION:
+        return None
+
+    return k, seeds
+
+def primer_seeds(primers, max_mismatches):
+    """
+    The seeds for the primers, by seed length. Each primer is cut into
+    max_mismatches + 1 pieces, so that every site within max_mismatches
+    has one of its seeds exactly.
+
+    Returns a dict of k -> dict of seed -> list of SeedSite, and the
+    primers that the seeds can't be used for, those have every
+    position checked instead
+    """
+
+    seeds = defaultdict(lambda: defaultdict(list))
+    scanned = []
+
+    for primer_id, primer in primers.iteritems():
+
+        cut = piece_seeds(primer, max_mismatches + 1)
+
+        if cut is None:
+            scanned.append(primer_id)
+            continue
+
+        k, primer_pieces = cut
+
+        for forward, offset, seed in primer_pieces:
+
+            for expanded in expand_iupac(seed):
+                seeds[k][expanded].append(
+                    SeedSite(primer_id, forward, offset))
+
+    if scanned:
+        log_message('Checking every position for {} primers that can\'t'
+            ' be seeded'.format(len(scanned)))
+
+    return seeds, scanned
+
+def seed_positions(contig, k, seeds):
+    # Where each of the seeds is in the contig
+    positions = defaultdict(list)
+
+    try:
+        from tools.packed import PackedSequence, pack_kmer
+
+    except ImportError:
+        # Without numpy, one window at a time
+        for i in xrange(len(contig) - k + 1):
+
+            kmer = contig[i:i+k]
+
+            if kmer in seeds:
+                positions[kmer].append(i)
+
+        return positions
+
+    # With numpy, every k-mer of the contig is looked up in
+    # the sorted seeds at once
+    import numpy as np
+
+    starts, codes = PackedSequence(contig).kmers(k)
+
+    names = sorted(seeds, key=pack_kmer)
+    index = np.array([pack_kmer(seed) for seed in names], dtype=np.uint64)
+
+    found = index.searchsorted(codes).clip(0, len(index) - 1)
+    hit = np.flatnonzero(index[found] == codes)
+
+    for start, seed in izip(starts[hit].tolist(), found[hit].tolist()):
+        positions[names[seed]].append(start)
+
+    return positions
+
+def ambiguous_sites(contig, primer_id, length):
+    # Every place the primer fits on the contig over something other
+    # than A, C, G or T, both strands. The seeds are plain bases
+    # so they never find these
+    last = len(contig) - length
+
+    for run in _AMBIGUOUS.finditer(contig):
+
+        for start in xrange(max(0, run.start() - length + 1),
+            min(run.end() - 1, last) + 1):
+
+            yield (primer_id, True, start)
+            yield (primer_id, False, start)
+
+def query_window(contig, start, length):
+    # The part of the contig under the primer, off the ends
+    # padded with N like find_targets does
+    stop = start + length
+
+    return 'N' * max(0, -start) + \
+        contig[max(0, start):min(stop, len(contig))] + \
+        'N' * max(0, stop - len(contig))
+
+def make_hit(contig_id, primer_id, primer, start, forward, mismatches):
+    # Looks just like an ungapped BLAST hit for the whole primer
+    hit = GenotypeHit()
+
+    length = len(primer)
+
+    hit.query_id = contig_id
+    hit.reference_id = primer_id
+    hit.reference_len = length
+    hit.forward = forward
+
+    hit.query_start = start
+    hit.query_stop = start + length - 1
+    hit.reference_start = 0
+    hit.reference_stop = length - 1
+
+    hit.absolute_len = length
+    hit.relative_len = 1.0
+    hit.num_mismatches = mismatches
+    hit.num_gap_opens = 0
+    hit.identity = 1.0 - float(mismatches) / float(length)
+    hit.reference_seq = primer
+    hit.full_match = mismatches == 0
+
+    return hit
+
+def scan_sites(contig, primer_id, primer, max_mismatches):
+    # Every place in the contig the primer could sit, both strands,
+    # for the primers that can't be seeded. Only the ones within
+    # max_mismatches when numpy is there to count them all at once
+    length = len(primer)
+
+    try:
+        from tools.iupac import window_mismatches
+
+    except ImportError:
+        return ((primer_id, forward, start) for forward in (True, False) \
+            for start in xrange(len(contig) - length + 1))
+
+    sites = []
+
+    for forward, oriented in ((True, primer),
+        (False, reverse_complement(primer))):
+
+        counts = window_mismatches(contig, oriented)
+
+        sites.extend((primer_id, forward, start) for start in \
+            (counts <= max_mismatches).nonzero()[0].tolist())
+
+    return sites
+
+def verify_sites(contig_id, contig, sites, primers, max_mismatches):
+    # The hits for the sites, (primer id, forward, start), where the
+    # primer has no more than max_mismatches mismatches
+    hits = []
+    sites = iter(sites)
+
+    while True:
+
+        chunk = list(islice(sites, _VERIFY_CHUNK))
+
+        if not chunk:
+            return hits
+
+        pairs = []
+
+        for primer_id, forward, start in chunk:
+
+            primer = primers[primer_id]
+            window = query_window(contig, start, len(primer))
+
+            if not forward:
+                window = reverse_complement(window)
+
+            pairs.append((window, primer))
+
+        mismatches = count_mismatches(pairs)
+
+        for (primer_id, forward, start), (window, primer), count in \
+            izip(chunk, pairs, mismatches):
+
+            if count > max_mismatches:
+                continue
+
+            hit = make_hit(
+                contig_id, primer_id, primer, start, forward, count)
+
+            hit.query_seq = window
+
+            hits.append(hit)
+
+def search_primers(primers, cached_query, max_mismatches):
+    """
+    Finds every place in the query that one of the primers (dict of
+    id -> sequence) matches, on either strand, with no more than
+    max_mismatches mismatches (check_mismatches). Primers hanging off
+    the end of a contig match the missing bases, same as find_targets,
+    if one of their seeds is on the contig. Sites over N or other IUPAC
+    codes in the contig are all checked.
+
+    Returns a PrimerResults with the hits
+    """
+
+    max_mismatches = int(max_mismatches)
+
+    seeds, scanned = primer_seeds(primers, max_mismatches)
+    scanned = set(scanned)
+
+    log_message('Searching for {} primers with {} seeds'.format(
+        len(primers), sum(len(k_seeds) for k_seeds in seeds.itervalues())))
+
+    hits = []
+
+    for contig_id, contig in cached_query.iteritems():
+
+        contig = str(contig)
+
+        # Each place a primer could sit, found by any of its seeds
+        candidates = set()
+
+        for k, k_seeds in seeds.iteritems():
+
+            for seed, positions in \
+                seed_positions(contig, k, k_seeds).iteritems():
+
+                for site in k_seeds[seed]:
+
+                    for position in positions:
+                        candidates.add((site.primer_id, site.forward,
+                            position - site.offset))
+
+        for primer_id in primers:
+
+            if primer_id not in scanned:
+                candidates.update(ambiguous_sites(
+                    contig, primer_id, len(primers[primer_id])))
+
+        hits.extend(verify_sites(contig_id, contig, sorted(candidates),
+            primers, max_mismatches))
+
+        for primer_id in scanned:
+            hits.extend(verify_sites(contig_id, contig, scan_sites(contig,
+                primer_id, primers[primer_id], max_mismatches), primers,
+                max_mismatches))
+
+    log_message('Found {} primer sites'.format(len(hits)))
+
+    return PrimerResults(hits)
+
+def self_check():
+    # Primer sites over N and IUPAC codes in the contig, found
+    # the same as checking every window
+    from tools.tools import check_mismatches
+
+    contig = 'ACGTTGCAGGTACCATGCATTTGACCAGTAGGCATCGATCGGATATCC'
+    primer = contig[10:30]
+
+    for site, max_mismatches in (
+        (contig[:15] + 'N' + contig[16:], 0),
+        (contig[:12] + 'R' + contig[13:20] + 'N' + contig[21:], 1),
+        (contig[:25] + 'A' + contig[26:31] + 'N' * 5 + contig[36:], 1)):
+
+        found = sorted((hit.query_start, hit.forward, hit.num_mismatches)
+            for hit in search_primers({'P&F': primer}, {'c': site},
+            max_mismatches).hits)
+
+        expected = []
+
+        for start in xrange(len(site) - len(primer) + 1):
+
+            window = site[start:start+len(primer)]
+
+            for forward, oriented in ((True, window),
+                (False, reverse_complement(window))):
+
+                count = check_mismatches(oriented, primer)
+
+                if count <= max_mismatches:
+                    expected.append((start, forward, count))
+
+        if found != sorted(expected) or not found:
+            raise RuntimeError('Primer search found {} in {}, expected'
+                ' {}'.format(found, site, sorted(expected)))
+
+    log_message('Primer search checks passed')
+
+if __name__ == '__main__':
+    self_check()
@@ -11,7 +11,7 @@
 import re
 import os
 import sys
-from itertools import izip, izip_longest, product, repeat
+from itertools import izip, product
 from collections import defaultdict, namedtuple
 
 from tools.tools import (
@@ -29,7 +29,7 @@ _asterisk = re.compile(r'[\*]')
 
 class ConsensusSequence(object):
 
-    def __init__(self):
+    def __init__(self, eager=False):
         self._start = -1
         self._stop = -1
         self._seq = []
@@ -37,6 +37,12 @@ class ConsensusSequence(object):
         self._ambiguous = {}
         self._ref = ''
 
+        # When eager, ambiguous positions are flattened as they are
+        # added so that the complexity is known while the sequence
+        # is still being built
+        self._eager = eager
+        self._complexity = 0
+
     def initialize(self, ref, start, stop, nuc, count, ref_call):
 
         self._start = start
@@ -49,7 +55,7 @@ class ConsensusSequence(object):
             cp = nuc
 
         if cp.ambiguous:
-            self._ambiguous[stop] = cp
+            self._track_ambiguous(stop-1, cp)
 
         self._seq.append(cp)
         self._count = count
@@ -72,7 +78,7 @@ class ConsensusSequence(object):
             raise RuntimeError('Adding to consensus sequence needs to be contiguous')
 
         if cp.ambiguous:
-            self._ambiguous[pos-1] = cp
+            self._track_ambiguous(pos-1, cp)
 
         self._stop += 1
         self._seq.append(cp)
@@ -110,8 +116,26 @@ class ConsensusSequence(object):
 
         return first
 
+    def _track_ambiguous(self, key, cp):
+
+        if self._eager:
+
+            # Flatten right away and keep the running total, positions
+            # that resolve to a single call are no longer ambiguous
+            still_ambiguous = cp.flatten()
+            self._complexity += cp.complexity
+
+            if not still_ambiguous:
+                return
+
+        self._ambiguous[key] = cp
+
     def flatten(self):
 
+        # Eager sequences were flattened while they were built
+        if self._eager:
+            return
+
         rm = []
 
         for k, v in self.ambiguous.iteritems():
@@ -121,6 +145,8 @@ class ConsensusSequence(object):
         for k in rm:
             del self.ambiguous[k]
 
+        self._complexity = sum(p.complexity for p in self.ambiguous.itervalues())
+
         self.count = sum(p.count for p in self)
 
     def get_fragment(self, start=None, stop=None):
@@ -132,48 +158,11 @@ class ConsensusSequence(object):
             stop = self.stop
 
         for i in range(start-1, stop):
-            if self.seq[i].ambiguous:
-
-                if isinstance(self.seq[i].nuc, basestring):
-                    yield self.seq[i].nuc
-
-                else:
-                    nucs_here = set(map(str.upper, self.seq[i].nuc))
-                    
-                    if '-' in nucs_here:
-                        yield 'N'
-                    
-                    else:
-                        nucs_here = set(nucs_here)
-                        
-                        yield_fstr = '[{}]'
-                        ins = []
-
-                        for n in nucs_here:
-                            if len(n) > 1:
-                                ins.append(n)
-
-                        for insertions in ins:
-                            nucs_here.discard(insertions)
-
-                        final_code = get_non_iupac(frozenset(nucs_here))
-
-                        if final_code is None:
-                            print(frozenset(str(nucs_here)))
-                            raise RuntimeError()
-
-                        if ins:
-                            ins.append(final_code)
-                            yield yield_fstr.format('|'.join(ins))
-
-                        else:
-                            yield final_code
-            else:
-                yield self.seq[i].nuc
+            yield position_fragment(self.seq[i])
 
     @property
     def complexity(self):
-        return sum(p.complexity for p in self.ambiguous.itervalues())
+        return self._complexity
 
     @property
     def ambiguous(self):
@@ -218,6 +207,41 @@ class ConsensusSequence(object):
     def __getitem__(self, index):
         return self._seq[index]
 
+def position_fragment(cp):
+    # The string representation of a single consensus position
+
+    if not cp.ambiguous or isinstance(cp.nuc, basestring):
+        return cp.nuc
+
+    nucs_here = set(map(str.upper, cp.nuc))
+
+    if '-' in nucs_here:
+        return 'N'
+
+    nucs_here = set(nucs_here)
+
+    yield_fstr = '[{}]'
+    ins = []
+
+    for n in nucs_here:
+        if len(n) > 1:
+            ins.append(n)
+
+    for insertions in ins:
+        nucs_here.discard(insertions)
+
+    final_code = get_non_iupac(frozenset(nucs_here))
+
+    if final_code is None:
+        print(frozenset(str(nucs_here)))
+        raise RuntimeError()
+
+    if ins:
+        ins.append(final_code)
+        return yield_fstr.format('|'.join(ins))
+
+    return final_code
+
 class ConsensusPosition(object):
 
     ambiguity_thresh = 1.0 / 3.0
@@ -572,6 +596,78 @@ def extend_detection_window(pile, processed_stack):
                 for _ in range(len(processed_stack)-i-1):
                     processed_stack.append(process_line(next(pile)))
 
+def window_call(column, slot):
+    # Reads that don't reach this far into the
+    # window are treated as deleted
+    if slot < len(column):
+        return column[slot]
+
+    return '-'
+
+def window_haplotypes(columns):
+
+    # Instead of building a tuple of calls for every read slot
+    # we label each slot as we stream through the window. Two
+    # slots share a label at position i only if they shared a label
+    # at position i-1 and have the same call at i, so at the end
+    # the labels identify the haplotypes exactly.
+    #
+    # If bowtie says that this is a deletion window
+    # Then it better be consistent
+    # Namely, this happens:
+    #   POS 108 -> .-3TTA
+    #   POS 109 -> A
+    #   POS 110 -> *
+    #   POS 111 -> T
+    #
+    # Clearly this is stupid, mpileup says there's a deletion here
+    # but that is not reflected in subsequent reads
+    #
+    # The opposite will also happen where:
+    #
+    #   POS 108 ->  .
+    #   POS 109 ->  *
+    #   POS 110 ->  *
+    #   POS 111 ->  *
+    #
+    # Clearly a deletion event of 3 was not flagged
+    # and yet all reads afterwards are deleted
+    #
+    # Returns (slot, label) for the reads that are consistent
+
+    depth = max(len(column) for column in columns) if columns else 0
+
+    labels = [0] * depth
+    deleted = [0] * depth
+
+    for i, column in enumerate(columns):
+
+        seen = {}
+        column_len = len(column)
+
+        for slot in xrange(depth):
+
+            call = column[slot] if slot < column_len else '-'
+
+            key = (labels[slot], call)
+            label = seen.get(key, None)
+
+            if label is None:
+                label = len(seen)
+                seen[key] = label
+
+            labels[slot] = label
+
+            # The call before the window doesn't count
+            # towards the deletion consistency
+            if i and call == '-':
+                deleted[slot] += 1
+
+    window_len = len(columns) - 1
+
+    return [(slot, labels[slot]) for slot in xrange(depth) \
+        if deleted[slot] == 0 or deleted[slot] == window_len]
+
 def detect_deletion_window(pile, ref, position, read_count, read_calls,
     current_consensus, ref_call):
 
@@ -614,7 +710,7 @@ def detect_deletion_window(pile, ref, position, read_count, read_calls,
                 count = read_count
             else:
                 count = processed_stack[i-1][3]
-            all_lines_fixed.append(repeat(l, count))
+            all_lines_fixed.append([l] * count)
 
     #
     # all_lines represents a window: [
@@ -630,43 +726,18 @@ def detect_deletion_window(pile, ref, position, read_count, read_calls,
     # and the last list being the last position in the deletion window
     #
 
-    sub_seq = []
-
-    for window in izip_longest(*all_lines_fixed, fillvalue='-'):
-        # If bowtie says that this is a deletion window
-        # Then it better be consistent
-        # Namely, this happens:
-        #   POS 108 -> .-3TTA
-        #   POS 109 -> A
-        #   POS 110 -> *
-        #   POS 111 -> T
-        #
-        # Clearly this is stupid, mpileup says there's a deletion here
-        # but that is not reflected in subsequent reads
-        #
-        # The opposite will also happen where:
-        #
-        #   POS 108 ->  .
-        #   POS 109 ->  *
-        #   POS 110 ->  *
-        #   POS 111 ->  *
-        #
-        # Clearly a deletion event of 3 was not flagged
-        # and yet all reads afterwards are deleted
-
-        if all(x=='-' for x in window[1:]):
-            sub_seq.append(tuple(window))
-
-        elif all(x!='-' for x in window[1:]):
-            sub_seq.append(tuple(window))
+    # Each read slot gets labeled with its haplotype across
+    # the window, only the reads that are consistent with
+    # a deletion (or no deletion at all) are kept
+    retained = window_haplotypes(all_lines_fixed)
 
     # We want to get the counts of the deletion window
     # meaning how many reads support a certain substring
-    counts = counter(sub_seq)
+    counts = counter(label for _, label in retained)
     to_remove = []
-    for seq, count in counts.iteritems():
-        if float(count) / len(sub_seq) < ConsensusPosition.ambiguity_thresh:
-            to_remove.append(seq)
+    for label, count in counts.iteritems():
+        if float(count) / len(retained) < ConsensusPosition.ambiguity_thresh:
+            to_remove.append(label)
 
     for rm in to_remove:
         del counts[rm]
@@ -713,8 +784,12 @@ def detect_deletion_window(pile, ref, position, read_count, read_calls,
         return 0
 
     elif len(counts) == 1:
-        final_seqs = counts.keys()[0]
-        count = counts.values()[0]
+        label, count = counts.items()[0]
+
+        # Any of the reads with this label will do
+        slot = next(slot for slot, l in retained if l == label)
+        final_seqs = [window_call(column, slot) for column in all_lines_fixed]
+
         current_consensus.add_nuc(ref, position, final_seqs[0], count, ref_call)
 
         for i, next_nuc in enumerate(final_seqs[1:]):
@@ -730,13 +805,12 @@ def detect_deletion_window(pile, ref, position, read_count, read_calls,
 
     else:
 
-        i = len(sub_seq)-1
-        while i >= 0:
-            if sub_seq[i] not in counts:
-                sub_seq.pop(i)
-            i-=1
+        slots = [slot for slot, label in retained if label in counts]
 
-        final_seqs = map(list, zip(*sub_seq))
+        final_seqs = [
+            [window_call(column, slot) for slot in slots] \
+                for column in all_lines_fixed
+        ]
 
         first_cp = ConsensusPosition(
             position,
@@ -772,17 +846,33 @@ def detect_deletion_window(pile, ref, position, read_count, read_calls,
 
         return 0
 
-def build_consensus(pileup_file, ambiguity_threshold):
+def reference_group(reference):
+    # stx1a_1_AB12345|1234 -> stx1a
+    return reference.split('|')[0].split('_')[0]
+
+def build_consensus(pileup_file, ambiguity_threshold, abandon=None,
+    sequence_type=ConsensusSequence):
+
+    # If provided, abandon is a callable that takes the reference
+    # name and the consensus built so far and returns True when
+    # the rest of this reference is not worth building.
+    # sequence_type is the consensus container to build, anything
+    # that looks like a ConsensusSequence will do.
 
     reference = None
-    current_consensus = ConsensusSequence()
+    eager = abandon is not None
+    current_consensus = sequence_type(eager=eager)
     position_offset = 0
     pile = pileup_iterator(flname=pileup_file)
     ConsensusPosition.ambiguity_thresh = ambiguity_threshold
-    
+    pending = None
+
     while pile:
 
-        next_line = next(pile)
+        if pending is None:
+            next_line = next(pile)
+        else:
+            next_line, pending = pending, None
 
         dels, ref, position, read_count, read_calls, reference_call = process_line(next_line)
 
@@ -792,17 +882,15 @@ def build_consensus(pileup_file, ambiguity_threshold):
 
             yield reference, current_consensus
 
-            current_consensus = ConsensusSequence()
+            current_consensus = sequence_type(eager=eager)
             position_offset = 0
 
         reference = ref
 
-
         if not read_count:
             current_consensus.add_nuc(reference, position+position_offset, '-', read_count, reference_call)
-            continue
 
-        if dels:
+        elif dels:
             position_offset += detect_deletion_window(
                 pile,
                 ref, position,
@@ -811,33 +899,74 @@ def build_consensus(pileup_file, ambiguity_threshold):
                 current_consensus,
                 reference_call
             )
-            continue
 
-        current_consensus.add_nuc(reference, position+position_offset, read_calls, read_count, reference_call)
+        else:
+            current_consensus.add_nuc(reference, position+position_offset, read_calls, read_count, reference_call)
+
+        if eager and abandon(reference, current_consensus):
+
+            # Skip the rest of the pileup for this reference,
+            # the first line of the next one is kept for the
+            # next iteration
+            pending = next(pile)
 
-def build_sequences(pileup_file, ambiguity_threshold, min_coverage, max_complexity):
+            while pending[0] == reference:
+                pending = next(pile)
+
+            current_consensus = sequence_type(eager=eager)
+            position_offset = 0
+
+def build_sequences(pileup_file, ambiguity_threshold, min_coverage, max_complexity,
+    vectorized=False):
+
+    # The vectorized consensus caller needs numpy so
+    # only import it when it is asked for
+    if vectorized:
+        from .rb_matrix import ConsensusMatrix
+        sequence_type = ConsensusMatrix
+
+    else:
+        sequence_type = ConsensusSequence
 
     final_sequences = {}
     final = []
 
+    # The least complex sequence found so far for each group
+    best = {}
+
+    def hopeless(reference, c_sequence):
+
+        # Complexity only goes up as positions are added so if we
+        # are already past the limit or can't beat a sequence
+        # we already have, there's no reason to keep going
+        if c_sequence.complexity > max_complexity:
+            return True
+
+        incumbent = best.get(reference_group(reference), None)
+
+        return incumbent is not None and \
+            c_sequence.complexity >= incumbent.complexity
+
     for reference, c_sequence in build_consensus(pileup_file,
-        ambiguity_threshold):
+        ambiguity_threshold, abandon=hopeless, sequence_type=sequence_type):
 
         if c_sequence.coverage < min_coverage:
             continue
 
-        if 'stx2a' in reference:
-            pause = 1
-
         c_sequence.flatten()
 
-        new_ref = reference.split('|')[0].split('_')[0]
+        new_ref = reference_group(reference)
 
         if new_ref in final_sequences:
             final_sequences[new_ref].append(c_sequence)
         else:
             final_sequences[new_ref] = [c_sequence]
 
+        if new_ref not in best or \
+            c_sequence.complexity < best[new_ref].complexity:
+
+            best[new_ref] = c_sequence
+
     for ref, seqs in final_sequences.iteritems():
         
         if not seqs:
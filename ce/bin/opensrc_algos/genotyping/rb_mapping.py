@@ -0,0 +1,171 @@
+###################################################################
+#
+# Maps the reads once for all of the reads based genotypers
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import os
+
+from tools.environment import (
+    log_message,
+    valid_dir
+)
+
+from tools.tools import (
+    fasta_iterator
+)
+
+from tools.bowtie import (
+    cached_bowtie_index
+)
+
+from tools.reads import (
+    genome_size,
+    kmer_prefilter,
+    subsample_reads
+)
+
+from tools.samtools import (
+    paired_bowtie2_sorted,
+    pile_up_sam
+)
+
+# Separates the genotyper from the reference
+# name in the combined panel
+_NAMESPACE = '::'
+
+def combine_panels(panel_files, out_file):
+    # Every reference gets the name of the genotyper it belongs
+    # to in front of it so the pileup can be split up again
+    with open(out_file, 'w') as f:
+
+        for genotyper, panel_file in panel_files:
+
+            for name, sequence in fasta_iterator(panel_file):
+                f.write('>{}{}{}\n{}\n'.format(
+                    genotyper, _NAMESPACE, name, sequence))
+
+def split_pileup(pileup_file, genotypers, out_dir):
+    """
+    Splits the pileup of the combined panel into one pileup
+    per genotyper, with the original reference names
+    """
+
+    out_paths = dict((genotyper, os.path.join(out_dir, genotyper + '.pup')) \
+        for genotyper in genotypers)
+
+    out_files = dict((genotyper, open(path, 'w')) \
+        for genotyper, path in out_paths.iteritems())
+
+    try:
+        with open(pileup_file, 'r') as f:
+
+            for line in f:
+
+                name, rest = line.split('\t', 1)
+                genotyper, _, reference = name.partition(_NAMESPACE)
+
+                if genotyper not in out_files:
+                    raise RuntimeError('Unknown reference in pileup: {}'.format(
+                        name))
+
+                out_files[genotyper].write(reference + '\t' + rest)
+
+    finally:
+        for f in out_files.itervalues():
+            f.close()
+
+    return out_paths
+
+def shared_setting(all_settings, setting):
+    # A mapping option only applies if every genotyper asked for
+    # it, the most conservative value is used
+    values = [settings[setting] for settings in all_settings]
+
+    if not all(values):
+        return None
+
+    return values
+
+def shared_reads(all_settings, reference, env):
+    # The reads to map, subsampled and screened only as much as
+    # all of the genotypers allow
+    query_reads = all_settings[0].query_reads
+
+    targets = shared_setting(all_settings, 'target_coverage')
+    size = genome_size(all_settings[0])
+
+    if targets and size:
+
+        log_message('Subsampling reads to {}x coverage...'.format(
+            max(targets)))
+
+        query_reads = subsample_reads(
+            query_reads,
+            os.path.join(env.localdir, 'subsampled'),
+            float(max(targets)) * size,
+            seed=all_settings[0]['subsample_seed'] or 0
+        )
+
+    if shared_setting(all_settings, 'kmer_prefilter'):
+
+        log_message('Screening reads for panel k-mers...')
+
+        query_reads = kmer_prefilter(
+            query_reads,
+            reference,
+            os.path.join(env.localdir, 'prefilter'),
+            k=min(settings['prefilter_k'] or 21 for settings in all_settings),
+            step=min(settings['prefilter_step'] or 5 for settings in all_settings)
+        )
+
+    return query_reads
+
+def shared_pileups(panels, env):
+    """
+    Maps the reads once against the combined reference panels of the
+    reads based genotypers. panels is a list of (genotyper, module,
+    settings) where the module provides reads_panel(settings, env,
+    out_file) to write out its references.
+
+    Returns the path of the pileup for each genotyper
+    """
+
+    valid_dir(env.localdir)
+
+    panel_files = []
+
+    for genotyper, module, settings in panels:
+
+        log_message('Dumping reference sequences for {}...'.format(genotyper))
+
+        panel_file = os.path.join(env.localdir, genotyper + '.fasta')
+        module.reads_panel(settings, env, panel_file)
+        panel_files.append((genotyper, panel_file))
+
+    combined_file = os.path.join(env.localdir, 'panels.fasta')
+    combine_panels(panel_files, combined_file)
+
+    log_message('Indexing reference files...')
+
+    index_file = cached_bowtie_index(combined_file, env)
+
+    query_reads = shared_reads(
+        [settings for _, _, settings in panels], combined_file, env)
+
+    log_message('Mapping reads against references...')
+
+    bam_sorted = paired_bowtie2_sorted(query_reads, env, index_path=index_file)
+
+    log_message('Creating pileup...')
+
+    pileup_path = pile_up_sam(bam_sorted, combined_file, env)
+
+    log_message('Success!')
+
+    return split_pileup(
+        pileup_path, [genotyper for genotyper, _, _ in panels], env.localdir)
@@ -0,0 +1,244 @@
+###################################################################
+#
+# Vectorized consensus calling for reads based detection
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import numpy as np
+
+from tools.tools import (
+    get_non_iupac
+)
+
+from .rb_detection import (
+    ConsensusPosition,
+    position_fragment
+)
+
+# The columns of the count matrix. The bases come first
+# so that they can be turned into a bitmask
+_CALLS = 'ACGTN-'
+_CALL_INDEX = dict((c, i) for i, c in enumerate(_CALLS))
+_DELETION = _CALL_INDEX['-']
+
+# When the running complexity is needed, positions get
+# flattened in blocks of this size
+_BLOCK_SIZE = 256
+
+def _iupac_table():
+    # The IUPAC code for every combination of the bases
+    # indexed by bitmask, None if there is no code for it
+    table = np.empty(1 << _DELETION, dtype=object)
+
+    for mask in range(len(table)):
+        nucs = frozenset(c for i, c in enumerate(_CALLS[:_DELETION]) \
+            if mask & (1 << i))
+
+        table[mask] = get_non_iupac(nucs)
+
+    return table
+
+_IUPAC_CODES = _iupac_table()
+_CALL_ARRAY = np.array(list(_CALLS), dtype=object)
+_BASE_BITS = 1 << np.arange(_DELETION)
+
+class ConsensusMatrix(object):
+    """
+    A drop-in for ConsensusSequence that keeps the calls for each
+    position as counts in a positions x {A,C,G,T,N,-} matrix and
+    flattens all of the positions at once.
+
+    Positions that can't be represented as counts (insertions,
+    positions coming out of a deletion window that should not be
+    analyzed, etc.) are kept aside as ConsensusPosition objects
+    and flattened the old way.
+    """
+
+    def __init__(self, eager=False):
+        self._start = -1
+        self._stop = -1
+        self._count = -1
+        self._ref = ''
+
+        # Same meaning as for ConsensusSequence, except that
+        # positions are flattened a block at a time
+        self._eager = eager
+        self._complexity = 0
+
+        # The flattened call for every position
+        self._fragments = []
+
+        # Positions waiting to be flattened
+        self._rows = []
+        self._ref_calls = []
+        self._slots = []
+
+        # Insertions and anything else that isn't a count
+        self._sparse = {}
+
+    def add_nuc(self, ref, pos, nuc, count, ref_call):
+
+        if self._start == -1:
+            self._start = pos
+            self._stop = pos
+            self._count = count
+            self._ref = ref
+
+        else:
+            assert self.ref == ref
+
+            if not pos == self._stop+1:
+                raise RuntimeError('Adding to consensus sequence needs to be contiguous')
+
+            self._stop += 1
+            self._count += count
+
+        slot = len(self._fragments)
+        self._fragments.append(None)
+
+        if isinstance(nuc, ConsensusPosition):
+
+            if not nuc.ambiguous or not nuc.analyze or \
+                not isinstance(nuc.nuc, list):
+
+                self._sparse[slot] = nuc
+                return
+
+            ref_call = nuc.ref_call
+            nuc = nuc.nuc
+
+        if isinstance(nuc, basestring):
+            self._fragments[slot] = nuc.upper()
+            return
+
+        calls = ''.join(nuc).upper()
+
+        # Only single nucleotide calls can be counted
+        if nuc and len(calls) == len(nuc):
+
+            counts = [calls.count(c) for c in _CALLS]
+
+            if sum(counts) == len(nuc):
+                self._rows.append(counts)
+                self._ref_calls.append(ref_call.upper())
+                self._slots.append(slot)
+
+                if self._eager and len(self._rows) >= _BLOCK_SIZE:
+                    self._flush()
+
+                return
+
+        self._sparse[slot] = ConsensusPosition(pos, nuc, count, ref_call)
+
+    def _flush(self):
+
+        for slot, cp in self._sparse.iteritems():
+            cp.flatten()
+            self._complexity += cp.complexity
+            self._fragments[slot] = cp
+
+        self._sparse = {}
+
+        if not self._rows:
+            return
+
+        counts = np.array(self._rows, dtype=np.int64)
+        total = counts.sum(axis=1).astype(np.float64)
+
+        # Same as ConsensusPosition.flatten, a call is kept if it is
+        # at least the ambiguity threshold of all the calls
+        keep = (counts > 0) & \
+            (counts / total[:, None] >= ConsensusPosition.ambiguity_thresh)
+
+        n_keep = keep.sum(axis=1)
+        best = keep.argmax(axis=1)
+
+        ref_calls = np.array(self._ref_calls, dtype=object)
+        ref_index = np.array(
+            [_CALL_INDEX.get(r, -1) for r in self._ref_calls], dtype=np.int64)
+
+        ref_kept = np.zeros(len(counts), dtype=bool)
+        has_ref = ref_index >= 0
+        ref_kept[has_ref] = keep[has_ref, ref_index[has_ref]]
+
+        # Only one call left
+        single = n_keep == 1
+
+        # More than one call, but the reference is one of them
+        reference = ~single & ref_kept
+
+        # Still ambiguous
+        ambiguous = ~single & ~ref_kept
+
+        fragments = np.empty(len(counts), dtype=object)
+        fragments[single] = _CALL_ARRAY[best[single]]
+        fragments[reference] = ref_calls[reference]
+
+        masks = keep[:, :_DELETION].dot(_BASE_BITS)
+        fragments[ambiguous] = _IUPAC_CODES[masks[ambiguous]]
+        fragments[ambiguous & keep[:, _DELETION]] = 'N'
+
+        self._complexity += int(
+            (single & (best != ref_index)).sum() + n_keep[ambiguous].sum())
+
+        for slot, fragment in zip(self._slots, fragments):
+            self._fragments[slot] = fragment
+
+        self._rows = []
+        self._ref_calls = []
+        self._slots = []
+
+    def flatten(self):
+        self._flush()
+
+    def get_fragment(self, start=None, stop=None):
+
+        self._flush()
+
+        if start is None:
+            start = self.start
+
+        if stop is None:
+            stop = self.stop
+
+        for fragment in self._fragments[start-1:stop]:
+
+            if isinstance(fragment, ConsensusPosition):
+                yield position_fragment(fragment)
+
+            elif fragment is None:
+                raise RuntimeError('No IUPAC code for ambiguous position')
+
+            else:
+                yield fragment
+
+    @property
+    def complexity(self):
+        return self._complexity
+
+    @property
+    def ref(self):
+        return self._ref
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def stop(self):
+        return self._stop
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def coverage(self):
+        return int(float(self.count) / float(self.stop - self.start + 1))
+
+    def __len__(self):
+        return len(self._fragments)
@@ -64,7 +64,12 @@ def main(settings, env):
     
     # Load it
     sequence_database = DbInfo(
-        database_path, seq_parser = resistance_seq_parser)
+        database_path,
+        seq_parser = resistance_seq_parser,
+        cache_dir = env.cachedir,
+        lazy = bool(settings['lazy_database']),
+        dedupe = bool(settings['dedupe_alleles'])
+    )
 
     # Loading the sequences
     log_message('Successfully loaded sequences')
@@ -15,6 +15,7 @@ __version__ = '1.0'
 from tools.environment import (
     log_algo_version,
     log_message,
+    log_warning,
     log_error,
     log_progress,
     write_results,
@@ -22,17 +23,35 @@ from tools.environment import (
 )
 
 from tools.species import (
-    run_ani
+    cached_ani
 )
 
 from tools.tools import (
     check_b64encoded
 )
 
+from tools.reads import (
+    plain_reads,
+    target_coverage_reads
+)
+
+from tools.cache import (
+    cached_build,
+    hash_files
+)
+
+from tools.dbinfo import (
+    loader_identity
+)
+
 import os
 import sys
 import csv
 import json
+import base64
+import cPickle as pickle
+import tempfile
+import threading
 import subprocess as sp
 from functools import partial
 from itertools import combinations
@@ -130,7 +149,20 @@ def assembly_run_seqsero(settings, env):
 
     # return local_dir
 
+def seqsero_reads(settings, env):
+    # The reads as SeqSero takes them, subsampled and plain text.
+    # Forks worker processes, so not from a background thread
+
+    query_reads = target_coverage_reads(settings, env)
+
+    # SeqSero only takes plain text reads
+    return plain_reads(
+        query_reads, os.path.join(env.localdir, 'reads'), threads=env.threads)
+
 def reads_run_seqsero(settings, env):
+    return run_seqsero(seqsero_reads(settings, env), env)
+
+def run_seqsero(query_reads, env, cancelled=None):
     # 
     # Seq_sero options:
     #   -m <int> (input data type, 
@@ -147,6 +179,9 @@ def reads_run_seqsero(settings, env):
     #                       default=sam; optional)
     # 
 
+    # With cancelled (a threading.Event) set, SeqSero is
+    # stopped and None is returned
+
     log_message('Running SeqSero {}'.format(__version__))
 
     local_dir = os.path.join(env.localdir, 'seq_sero')
@@ -158,76 +193,109 @@ def reads_run_seqsero(settings, env):
         sys.executable,
         os.path.join(env.toolsdir, 'SeqSero', 'SeqSero.py'),
         '-m', str(2),
-        '-i', settings.query_reads[0],
-        settings.query_reads[1]
+        '-i', query_reads[0],
+        query_reads[1]
     ]
 
-    child = sp.Popen(cmd_args, cwd=local_dir, stdout=sp.PIPE, stderr=sp.PIPE)
+    # Files instead of pipes, so it can be waited on
+    # a bit at a time without filling them up
+    with tempfile.TemporaryFile() as stdout, \
+        tempfile.TemporaryFile() as stderr:
+
+        child = sp.Popen(cmd_args, cwd=local_dir, stdout=stdout, stderr=stderr)
+
+        while child.poll() is None:
+
+            if cancelled is None:
+                child.wait()
+
+            elif cancelled.wait(1.0):
+                child.kill()
+                child.wait()
 
-    stdout, stderr = child.communicate()
+                log_message('SeqSero cancelled')
+                return None
 
-    exit_code = child.returncode
+        exit_code = child.returncode
 
-    if exit_code:
-        log_error(stderr.strip())
-        raise RuntimeError('Error running SeqSero')
+        if exit_code:
+            stderr.seek(0)
+            log_error(stderr.read().strip())
+            raise RuntimeError('Error running SeqSero')
 
     log_message('Done running SeqSero')
 
     return local_dir
 
-def interpret_insilicopcr(env, ssp_antigenic, sslookup):
-    
-    # First make sure this is something that we have information for
-    if not sslookup.c_table.get(ssp_antigenic, False):
-        return None
+class SeqSeroRun(threading.Thread):
+    """
+    Runs SeqSero on the reads (from seqsero_reads) in the background,
+    so that it can go alongside ANI. result() waits for it and gives
+    back the SeqSero directory, None if it was cancelled
+    """
+
+    def __init__(self, query_reads, env):
+        super(SeqSeroRun, self).__init__()
+
+        self.daemon = True
+
+        self._query_reads = query_reads
+        self._env = env
+        self._cancelled = threading.Event()
+        self._local_dir = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._local_dir = run_seqsero(
+                self._query_reads, self._env, self._cancelled)
+
+        except:
+            self._error = sys.exc_info()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def result(self):
+        self.join()
+
+        # Whatever went wrong doesn't matter once it's cancelled
+        if self._error is not None and not self._cancelled.is_set():
+            raise self._error[0], self._error[1], self._error[2]
+
+        return self._local_dir
+
+def load_insilicopcr(env):
+    # The insilico PCR loci and whether they were found,
+    # None if insilico PCR has no results
 
     insilicopcr_path = os.path.join(env.resultsdir, 'insilicopcr.json')
 
     if not os.path.exists(insilicopcr_path):
         return None
 
+    with open(insilicopcr_path, 'r') as f:
+        data = f.read()
+
+    if check_b64encoded(data):
+        pcr_results = json.loads(base64.b64decode(data))
     else:
-        with open(insilicopcr_path, 'r') as f:
-            data = f.read()
+        pcr_results = json.loads(data)
 
-        if check_b64encoded(data):
-            pcr_results = json.loads(base64.b64decode(data))
-        else:
-            pcr_results = json.loads(data)
+    return pcr_results.get('results', {})
 
-    lines = sslookup.c_table[ssp_antigenic]
-    condensed_view = pcr_results.get('results', {})
+def interpret_insilicopcr(env, ssp_antigenic, sslookup):
     
-    if not condensed_view:
+    # First make sure this is something that we have information for
+    if not sslookup.c_table.get(ssp_antigenic, False):
         return None
-    
-    serotype = ''
-
-    for line in lines:
-        if serotype:
-            break
-
-        sslkp_arr = [k for k in line.iterkeys() if k != 'BN Serotype']
-        sslkp_arr.sort()
 
-        sslkp_vals = [line[k] for k in sslkp_arr]
-        pcr_vals = [condensed_view[k] for k in sslkp_arr]
+    condensed_view = load_insilicopcr(env)
 
-        found = True
-
-        for lkp_val, pcr_val in zip(sslkp_vals, pcr_vals):
-
-            if lkp_val == pcr_val:
-                continue
-            else:
-                found = False
-                break
-
-        if found:
-            serotype = line.get('BN Serotype')
+    if not condensed_view:
+        return None
 
-    return serotype
+    return sslookup.resolve(ssp_antigenic, condensed_view)
 
 def interpret_results(results, sslookup, settings, env):
 
@@ -292,27 +360,64 @@ def main(settings, env):
     database_path = env.get_sharedpath(settings.database)
 
     # Create the lookup table object
-    sslookup = SeqSeroLookup(database_path)
+    sslookup = SeqSeroLookup(database_path, cache_dir=env.cachedir)
 
     results = {
         'formula' : '',
         'serotype' : ''
     }
 
-    if not settings.ani_value:
-        ani_results = run_ani(settings.query, env)
-        best = ani_results.interpret(settings)
+    # SeqSero is of no use for S. bongori, when that is already
+    # known the reads aren't got ready for it at all
+    seqsero = None
 
-        if best is not None:
-            settings.ani_value = best.taxonomy[2].strip()
+    if settings.ani_value != 'S. bongori':
 
-        else:
-            results['serotype'] = 'Needs further review'
+        # The reads are got ready first, that uses all of the threads
+        query_reads = seqsero_reads(settings, env)
+
+        # SeqSero doesn't need the ANI result until it is interpreted,
+        # the two run side by side. ANI leaves one of the threads
+        # over, SeqSero takes that one
+        seqsero = SeqSeroRun(query_reads, env)
+        seqsero.start()
+
+    try:
+        if not settings.ani_value:
+            ani_results = cached_ani(
+                settings.query,
+                env,
+                top_references = settings['ani_top_references']
+            )
+            best = ani_results.interpret(settings)
+
+            if best is not None:
+                settings.ani_value = best.taxonomy[2].strip()
+
+            else:
+                results['serotype'] = 'Needs further review'
+
+    except:
+        if seqsero is not None:
+            seqsero.cancel()
+            seqsero.join()
 
-    if settings.ani_value is not None:
+        raise
 
-        # Run Seq Sero
-        local_dir = reads_run_seqsero(settings, env)
+    local_dir = None
+
+    if seqsero is not None:
+
+        # SeqSero is of no use for these
+        if settings.ani_value is None or settings.ani_value == 'S. bongori':
+            seqsero.cancel()
+
+        local_dir = seqsero.result()
+
+    if settings.ani_value == 'S. bongori':
+        results['serotype'] = 'Needs further review'
+
+    elif local_dir is not None:
 
         # Parse the results
         parse_results(local_dir, results)
@@ -327,11 +432,16 @@ def main(settings, env):
 
     write_results('salmonella.serotype.json', json.dumps(results_out))
 
+# The contingency lines of a formula: loci are the bits of the masks,
+# groups are the lines that care about the same loci, (care mask,
+# dict of found mask -> first line as (line number, serotype))
+ContingencyIndex = namedtuple('ContingencyIndex', ['loci', 'groups'])
+
 class SeqSeroLookup(object):
     # This is going to be a fancy wrapper for a couple 
     # dictionaries
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, cache_dir=None):
 
         if not os.path.exists(db_path) or not os.path.isdir(db_path):
             raise RuntimeError('Not a valid path for Salmonella serotyping')
@@ -339,11 +449,16 @@ class SeqSeroLookup(object):
         self.lookup_table = defaultdict(dict)
         self.contingency_table = {}
         self.unresolved_formulas = set()
+        self._index = {}
         self._db_path = db_path
 
-        self.load()
+        if cache_dir is None:
+            self.load()
 
-    def load(self):
+        else:
+            self.load_compiled(cache_dir)
+
+    def table_paths(self):
 
         lookup_table_files = {
             'lookup' : 'lookup_table.csv',
@@ -357,9 +472,51 @@ class SeqSeroLookup(object):
             if not os.path.exists(file_path):
                 raise RuntimeError('Missing: {}'.format(file))
 
-        lookup_path = os.path.join(self._db_path, lookup_table_files['lookup'])
+        return dict((name, os.path.join(self._db_path, file)) for \
+            name, file in lookup_table_files.iteritems())
+
+    def load_compiled(self, cache_dir):
+        # The tables as they are once loaded and compiled, kept in
+        # the shared cache for every version of the tables
+
+        paths = self.table_paths()
+        loaded = []
+
+        def builder(directory):
+
+            self.load()
+            loaded.append(True)
+
+            state = dict((name, value) for name, value in \
+                vars(self).iteritems() if name != '_db_path')
 
-        with open(lookup_path, 'r') as f:
+            with open(os.path.join(directory, 'lookup.pickle'), 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+        try:
+            entry = cached_build(os.path.join(cache_dir, 'seqsero_lookup'),
+                hash_files([paths['lookup'], paths['contingency']],
+                extra=loader_identity(type(self))), builder)
+
+            if not loaded:
+
+                with open(os.path.join(entry, 'lookup.pickle'), 'rb') as f:
+                    vars(self).update(pickle.load(f))
+
+        except (IOError, OSError, EOFError, AttributeError, ImportError,
+            pickle.PickleError) as e:
+
+            log_warning('Could not use the compiled lookup tables: {}'.format(
+                str(e)))
+
+            if not loaded:
+                self.load()
+
+    def load(self):
+
+        paths = self.table_paths()
+
+        with open(paths['lookup'], 'r') as f:
             reader = csv.reader(f)
             header = next(reader)
 
@@ -372,9 +529,93 @@ class SeqSeroLookup(object):
                 self.lookup_table[subspecies][seq_sero_form] = final_serotype
                 self.unresolved_formulas.add(seq_sero_form)
 
-        contingency_path = os.path.join(self._db_path, lookup_table_files['contingency'])
+        self.build_contingency(paths['contingency'])
+
+        self.compile_contingency()
+
+    def compile_contingency(self):
+        """
+        Turns the contingency lines of each formula into bitmasks of the
+        loci they care about and the ones that should be found, so
+        that finding the line that matches the insilico PCR results
+        is a lookup for each set of loci instead of a scan
+        """
+
+        self._index = {}
+
+        for formula, lines in self._table.iteritems():
+
+            loci = sorted(set(key for line in lines for \
+                key in line if key != 'BN Serotype'))
+
+            bits = dict((locus, 1 << i) for i, locus in enumerate(loci))
+
+            groups = []
+            by_care = {}
+
+            for number, line in enumerate(lines):
+
+                # Same as a line that doesn't match, the
+                # next one is looked at instead
+                if not line.get('BN Serotype'):
+                    continue
+
+                care = 0
+                value = 0
+
+                for key, found in line.iteritems():
+
+                    if key == 'BN Serotype':
+                        continue
+
+                    care |= bits[key]
+
+                    if found:
+                        value |= bits[key]
+
+                if care not in by_care:
+                    by_care[care] = {}
+                    groups.append((care, by_care[care]))
+
+                by_care[care].setdefault(value, (number, line['BN Serotype']))
+
+            self._index[formula] = ContingencyIndex(loci, groups)
+
+    def resolve(self, formula, pcr_results):
+        # The serotype of the first contingency line for the formula
+        # that agrees with the insilico PCR results (locus -> found),
+        # '' if none of them do
+
+        index = self._index.get(formula)
+
+        if index is None:
+            return ''
+
+        found = 0
+        tested = 0
+
+        for i, locus in enumerate(index.loci):
+
+            if locus in pcr_results:
+                tested |= 1 << i
+
+                if pcr_results[locus]:
+                    found |= 1 << i
+
+        best = None
+
+        for care, values in index.groups:
+
+            # Every locus the lines care about has to be in the results
+            if care & ~tested:
+                continue
+
+            line = values.get(found & care)
+
+            if line is not None and (best is None or line < best):
+                best = line
 
-        self.build_contingency(contingency_path)
+        return best[1] if best is not None else ''
 
     def build_contingency(self, contingency_path):
 
@@ -17,16 +17,34 @@ from .tools import (
 )
 from .environment import (
     log_message,
+    log_error,
+    log_warning,
     valid_dir,
     full_path
 )
+from .cache import (
+    cached_build,
+    file_identity,
+    hash_files
+)
+
+def bowtie_indexer_path(env):
+
+    bowtie_index_path = full_path(
+        os.path.join(env.toolsdir, 'all_tools', 'bowtie2-build')
+    )
+
+    if not os.path.exists(bowtie_index_path):
+        raise RuntimeError('Missing Bowtie2 indexer')
+
+    return bowtie_index_path
 
 def bowtie_index(reference, env, name=''):
 
     if not isinstance(reference, basestring) or not \
         os.path.exists(reference):
 
-        raise RuntimeError('Invalid reference file provided: {}'.foramt(
+        raise RuntimeError('Invalid reference file provided: {}'.format(
             str(reference)))
 
     if name:
@@ -40,18 +58,50 @@ def bowtie_index(reference, env, name=''):
 
     valid_dir(index_dir)
 
-    bowtie_index_path = full_path(
-        os.path.join(env.toolsdir, 'all_tools', 'bowtie2-build')
-    )
+    build_bowtie_index(reference, index_dir, env)
 
-    if not os.path.exists(bowtie_index_path):
-        raise RuntimeError('Missing Bowtie2 indexer')
+    return index_dir
+
+def cached_bowtie_index(reference, env):
+    """
+    Same as bowtie_index, except the index is built once for
+    every unique reference panel and kept in the shared cache
+    so that the next job with the same panel can skip it
+    """
+
+    if not isinstance(reference, basestring) or not \
+        os.path.exists(reference):
+
+        raise RuntimeError('Invalid reference file provided: {}'.format(
+            str(reference)))
+
+    # A new bowtie2 might write a different index
+    key = hash_files(
+        [reference], extra=[file_identity(bowtie_indexer_path(env))])
+
+    cache_dir = os.path.join(env.cachedir, 'bowtie2')
+
+    def builder(directory):
+        build_bowtie_index(reference, os.path.join(directory, 'index'), env)
+
+    try:
+        entry = cached_build(cache_dir, key, builder)
+
+    except (IOError, OSError) as e:
+        log_warning('Could not use the bowtie2 index cache: {}'.format(
+            str(e)))
+
+        return bowtie_index(reference, env)
+
+    return os.path.join(entry, 'index')
+
+def build_bowtie_index(reference, index_prefix, env):
 
     cmd_args = [
         full_path(sys.executable),
-        bowtie_index_path,
+        bowtie_indexer_path(env),
         reference,
-        index_dir
+        index_prefix
     ]
 
     log_message('Running bowtie2 index args: {}'.format(
@@ -63,9 +113,13 @@ def bowtie_index(reference, env, name=''):
         log_error(err.strip())
         raise RuntimeError('Error building bowtie2 index')
 
-    return index_dir
-
-def paired_bowtie2(read_files, env, index_path='', reference= ''):
+def paired_bowtie2_args(read_files, env, index_path='', reference='',
+    threads=None):
+    """
+    Builds the bowtie2 commandline for mapping paired reads. Without
+    an output file bowtie2 writes the SAM records to stdout. Uses
+    all but one of the job's threads unless told otherwise
+    """
 
     if not isinstance(read_files, list) or not \
         all(os.path.exists(x) for x in read_files):
@@ -85,13 +139,8 @@ def paired_bowtie2(read_files, env, index_path='', reference= ''):
 
         index_path = bowtie_index(reference, env)
 
-    output_dir = full_path(
-        os.path.join(env.localdir, 'bowtie')
-    )
-
-    output_filename = os.path.join(output_dir, 'output.sam')
-
-    valid_dir(output_dir)
+    if threads is None:
+        threads = env.threads-1
 
     # This function is expecting that the read files are in the following order:
     # read_files = [R1, R2]
@@ -100,17 +149,37 @@ def paired_bowtie2(read_files, env, index_path='', reference= ''):
         bowtie2_path,
         '-x',
         index_path,
-        '-p', str(env.threads-1),
+        '-p', str(threads),
         '--reorder',
         '--local',
         '--sensitive-local',
         '--no-unal',
         '--all',
         '-1', read_files[0],
-        '-2', read_files[1],
-        '-S', output_filename
+        '-2', read_files[1]
     ]
 
+    return cmd_args
+
+def paired_bowtie2(read_files, env, index_path='', reference= ''):
+
+    cmd_args = paired_bowtie2_args(
+        read_files,
+        env,
+        index_path=index_path,
+        reference=reference
+    )
+
+    output_dir = full_path(
+        os.path.join(env.localdir, 'bowtie')
+    )
+
+    output_filename = os.path.join(output_dir, 'output.sam')
+
+    valid_dir(output_dir)
+
+    cmd_args += ['-S', output_filename]
+
     log_message('Running bowtie2 args: {}'.format(
         ' '.join(cmd_args)))
 
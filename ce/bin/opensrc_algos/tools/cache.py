@@ -0,0 +1,134 @@
+###################################################################
+#
+# A shared on-disk cache for things that are expensive to build
+# and can be reused from job to job
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on this platform, the rename below
+    # still keeps the cache consistent, we might just
+    # build the same thing twice
+    fcntl = None
+
+from .environment import (
+    log_message,
+    valid_dir
+)
+
+# Written last so that an entry without it
+# is never mistaken for a finished one
+_READY_FILE = '.ready'
+
+def hash_files(paths, extra=None):
+    """
+    Hashes the contents of the files plus anything in extra
+    (converted to str) that should also invalidate the cache
+    """
+
+    hasher = hashlib.sha1()
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(block)
+
+    if extra is not None:
+        for item in extra:
+            hasher.update(str(item))
+
+    return hasher.hexdigest()
+
+def file_identity(path):
+    # Cheap stand-in for the version of an executable
+    # or any other file we don't want to read in full
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+
+    return '{}:{}:{}'.format(path, stat.st_size, int(stat.st_mtime))
+
+class CacheLock(object):
+    # Exclusive lock on a file next to the cache entry. We use
+    # lockf since those locks also work over NFS
+    def __init__(self, path):
+        self._path = path
+        self._flobj = None
+
+    def __enter__(self):
+        self._flobj = open(self._path, 'a')
+
+        if fcntl is not None:
+            fcntl.lockf(self._flobj, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if fcntl is not None:
+            fcntl.lockf(self._flobj, fcntl.LOCK_UN)
+
+        self._flobj.close()
+
+def is_cached(cache_dir, key):
+    return os.path.exists(os.path.join(cache_dir, key, _READY_FILE))
+
+def cached_build(cache_dir, key, builder):
+    """
+    Returns the directory holding the entry for key in cache_dir.
+    If it doesn't exist yet, builder is called with an empty
+    directory to fill. Only one job builds an entry at a time and
+    the finished entry is moved into place in one step, so other
+    jobs never see half of it.
+    """
+
+    entry = os.path.join(cache_dir, key)
+
+    if is_cached(cache_dir, key):
+        log_message('Found cached entry: {}'.format(entry))
+        return entry
+
+    valid_dir(cache_dir)
+
+    with CacheLock(entry + '.lock'):
+
+        # Someone else might have built it while we waited
+        if is_cached(cache_dir, key):
+            log_message('Found cached entry: {}'.format(entry))
+            return entry
+
+        building = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+
+        try:
+            builder(building)
+
+            with open(os.path.join(building, _READY_FILE), 'w'):
+                pass
+
+            # mkdtemp makes it private to us
+            os.chmod(building, 0o755)
+
+            # Without the ready file, whatever is
+            # there can't be trusted
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+
+            os.rename(building, entry)
+
+        except:
+            shutil.rmtree(building, ignore_errors=True)
+            raise
+
+    log_message('Added entry to cache: {}'.format(entry))
+
+    return entry
@@ -11,6 +11,8 @@
 
 import os
 import sys
+import signal
+import tempfile
 import subprocess
 import threading
 
@@ -95,4 +97,88 @@ def popen(args, stdout=None, stderr=None, cwd=None, shell=False):
 
     out, err = child.communicate()
 
-    return child.returncode, out, err
\ No newline at end of file
+    return child.returncode, out, err
+
+def restore_sigpipe():
+    # Python ignores SIGPIPE and children inherit that, so a
+    # stage writing into a dead pipe would keep going instead
+    # of dying like it would in a shell
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def popen_pipeline(commands, stdout=None, cwd=None):
+    """
+    Runs the commands with the stdout of each one piped into the
+    stdin of the next, the same as cmd1 | cmd2 | cmd3 in a shell.
+    Nothing is written to disk between the stages.
+
+    The stderr of every stage is collected in a temporary file so
+    that a chatty stage can't block the pipeline. Returns a list of
+    (return code, stderr) with one entry per command.
+    """
+
+    if not isinstance(commands, list) or not commands or \
+        not all(isinstance(args, list) for args in commands):
+
+        raise RuntimeError('Provided commands must be a list of'
+            ' argument lists')
+
+    devnull = None
+
+    if not stdout:
+        stdout = devnull = open(os.devnull, 'wb')
+
+    children = []
+    errors = []
+    previous = None
+
+    try:
+        for i, args in enumerate(commands):
+
+            last = i == len(commands) - 1
+
+            err = tempfile.TemporaryFile()
+            errors.append(err)
+
+            child = subprocess.Popen(
+                                    args,
+                                    stdin=previous,
+                                    stdout=stdout if last else subprocess.PIPE,
+                                    stderr=err,
+                                    cwd=cwd,
+                                    preexec_fn=restore_sigpipe
+                                )
+
+            # The next stage owns the read end now, closing our
+            # copy lets the writer see it if the reader dies
+            if previous is not None:
+                previous.close()
+
+            previous = child.stdout
+            children.append(child)
+
+    except OSError:
+
+        for child in children:
+            if child.poll() is None:
+                child.kill()
+
+            child.wait()
+
+        if devnull is not None:
+            devnull.close()
+
+        raise
+
+    results = []
+
+    for child, err in zip(children, errors):
+        child.wait()
+
+        err.seek(0)
+        results.append((child.returncode, err.read()))
+        err.close()
+
+    if devnull is not None:
+        devnull.close()
+
+    return results
@@ -9,18 +9,40 @@
 ###################################################################
 
 import os
+import gc
+import marshal
+import hashlib
+import cPickle as pickle
+from functools import partial
 from collections import namedtuple, defaultdict
 
 from .tools import (
-    parse_fasta,
+    load_fasta,
+    stored_fasta,
     is_fasta,
 )
 
+from .faidx import (
+    IndexedFasta
+)
+
 from .environment import (
     check_dir,
+    log_message,
+    log_warning,
     valid_dir
 )
 
+from .cache import (
+    cached_build,
+    file_identity,
+    hash_files
+)
+
+# Bump whenever what goes into a snapshot changes
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_FILE = 'dbinfo.pickle'
+
 # 'Structs' for datastorage
 SequenceInfo = namedtuple('SequenceInfo', [
     'locus', 'allele', 'accession', 'sequence', 'other'])
@@ -61,21 +83,223 @@ def notes_parser(line, sep=':'):
         other = parts[2]
     )
 
+def code_identity(f):
+    # The name of a function (or partial) plus a hash of its
+    # code, so that changing the function changes this
+    if isinstance(f, partial):
+        return '{}({}, {})'.format(
+            code_identity(f.func),
+            repr(f.args),
+            repr(sorted((f.keywords or {}).items()))
+        )
+
+    name = '{}.{}'.format(
+        getattr(f, '__module__', None),
+        getattr(f, '__name__', type(f).__name__)
+    )
+
+    code = getattr(f, '__code__', None)
+
+    if code is None:
+        return name
+
+    return '{}:{}'.format(name, hashlib.sha1(marshal.dumps(code)).hexdigest())
+
+def loader_identity(cls):
+    # Everything the class and the DbInfo classes
+    # it is built on do to load a database
+    identity = []
+
+    for klass in cls.__mro__:
+
+        if klass is object:
+            continue
+
+        identity.append('{}.{}'.format(klass.__module__, klass.__name__))
+
+        for name, value in sorted(vars(klass).items()):
+
+            if callable(value):
+                identity.append(code_identity(value))
+
+    return identity
+
 class DbInfo(object):
     # Class that will hold the db information
     def __init__(self, dirpath, seq_parser = sequence_parser,
-        note_parser = notes_parser):
+        note_parser = notes_parser, packed = False, cache_dir = None,
+        lazy = False, dedupe = False):
 
         self._notes = {}
         self._sequences = {}
         self._dirpath = dirpath
         self._separator = None
 
+        # Lazy databases only index where the sequences are,
+        # they are read from the files when they are asked for
+        self._lazy = lazy
+        self._cache_dir = cache_dir
+
+        # Alleles with the same sequence are exported once, under
+        # the first of their ids, and results only ever name that one.
+        # duplicates: allele -> the one it is exported under
+        self._dedupe = dedupe
+        self._duplicates = {}
+
         if dirpath is None or not check_dir(dirpath):
             raise RuntimeError('Invalid path provided for '
                 ' database fastas: {}'.format(str(dirpath)))
 
-        self.load_database(dirpath, seq_parser, note_parser)
+        # With a cache dir, the parsed database is kept as a snapshot
+        # there and only reparsed when the database or parsers change
+        if cache_dir is not None:
+            self.load_snapshot(cache_dir, seq_parser, note_parser)
+
+        else:
+            self.compile_database(seq_parser, note_parser)
+
+        if packed:
+            self.pack_sequences()
+
+    def snapshot_key(self, snapshot_dir, seq_parser, note_parser):
+        # The files of the database directory, the parsers
+        # and the loading code
+        names = sorted(name for name in os.listdir(self._dirpath) if \
+            not name.startswith('.') and \
+            os.path.isfile(os.path.join(self._dirpath, name)))
+
+        paths = [os.path.join(self._dirpath, name) for name in names]
+
+        extra = [_SNAPSHOT_VERSION, self._lazy, self._dedupe,
+            code_identity(seq_parser),
+            code_identity(note_parser)] + names + loader_identity(type(self))
+
+        # Hashing the files takes about as long as parsing them, so
+        # the hash is remembered for as long as the files look the same
+        memo_path = os.path.join(snapshot_dir, hash_files([], extra=extra + \
+            [file_identity(path) for path in paths]) + '.key')
+
+        if os.path.exists(memo_path):
+            with open(memo_path, 'r') as f:
+                return f.read().strip()
+
+        key = hash_files(paths, extra=extra)
+
+        try:
+            valid_dir(snapshot_dir)
+
+            with open(memo_path, 'w') as f:
+                f.write(key)
+
+        except (IOError, OSError):
+            pass
+
+        return key
+
+    def snapshot_state(self):
+        # Everything load_database sets up, lazy sequences
+        # only pickle where they are
+        return dict((name, value) for name, value in \
+            vars(self).iteritems() if name not in ('_dirpath', '_cache_dir'))
+
+    def load_snapshot(self, cache_dir, seq_parser, note_parser):
+
+        loaded = []
+
+        def builder(directory):
+
+            self.compile_database(seq_parser, note_parser)
+            loaded.append(True)
+
+            with open(os.path.join(directory, _SNAPSHOT_FILE), 'wb') as f:
+                pickle.dump(self.snapshot_state(), f, pickle.HIGHEST_PROTOCOL)
+
+        snapshot_dir = os.path.join(cache_dir, 'dbinfo')
+
+        try:
+            entry = cached_build(snapshot_dir,
+                self.snapshot_key(snapshot_dir, seq_parser, note_parser),
+                builder)
+
+            if not loaded:
+
+                with open(os.path.join(entry, _SNAPSHOT_FILE), 'rb') as f:
+
+                    # Nothing in there has cycles, the collector would
+                    # only keep rescanning the objects as they come in
+                    gc.disable()
+
+                    try:
+                        state = pickle.load(f)
+
+                    finally:
+                        gc.enable()
+
+                if not isinstance(state, dict):
+                    raise ValueError('Not a database snapshot')
+
+                vars(self).update(state)
+
+                log_message('Loaded database snapshot: {}'.format(entry))
+
+        # A corrupt snapshot can fail to unpickle in about any way,
+        # the database is just parsed again
+        except Exception as e:
+
+            log_warning('Could not use the database snapshot: {}'.format(
+                str(e)))
+
+            if not loaded:
+                self.compile_database(seq_parser, note_parser)
+
+    def compile_database(self, seq_parser, note_parser):
+        # Everything that goes into a snapshot
+        self.load_database(self._dirpath, seq_parser, note_parser)
+
+        if self._dedupe:
+            self.dedupe_sequences()
+
+    def dedupe_sequences(self):
+
+        groups = defaultdict(list)
+
+        for seq_id, seq_info in self._sequences.iteritems():
+
+            sequence = getattr(seq_info, 'sequence', seq_info)
+
+            # Lazy sequences are only read to be hashed
+            groups[hashlib.sha1(str(sequence)).digest()].append(seq_id)
+
+        for members in groups.itervalues():
+
+            if len(members) < 2:
+                continue
+
+            members.sort()
+
+            for member in members[1:]:
+                self._duplicates[member] = members[0]
+
+        log_message('{} alleles share their sequence with another'.format(
+            len(self._duplicates)))
+
+    def pack_sequences(self):
+        # Stores the sequences 2 bits per base, needs numpy
+        try:
+            from .packed import PackedSequence
+
+        except ImportError:
+            log_warning('NumPy is not available, sequences will not be packed')
+            return
+
+        for seq_id, seq_info in self._sequences.iteritems():
+
+            if isinstance(seq_info, basestring):
+                self._sequences[seq_id] = PackedSequence(seq_info)
+
+            elif isinstance(getattr(seq_info, 'sequence', None), basestring):
+                self._sequences[seq_id] = seq_info._replace(
+                    sequence = PackedSequence(seq_info.sequence))
 
     def load_database(self, dirpath, seq_parser, note_parser):
 
@@ -96,7 +320,7 @@ class DbInfo(object):
                 continue
 
             # Load the sequences themselves from the files
-            sequences = parse_fasta(file_path)
+            sequences = self.load_sequences(file_path)
 
             for seq_id, sequence in sequences.iteritems():
                 # Create a named tuple that contains the 
@@ -154,6 +378,41 @@ class DbInfo(object):
 
                     self._notes[notes_info.locus] = notes_info
 
+    def load_sequences(self, file_path):
+
+        if not self._lazy:
+            return load_fasta(file_path)
+
+        try:
+            # The database directory may not be ours to write the
+            # index to, it is kept in memory (or in the snapshot)
+            sequences = IndexedFasta(file_path, write_index=False)
+
+        except RuntimeError as e:
+
+            if self._cache_dir is None:
+                log_warning('Unable to index {}: {}, loading it'
+                    ' instead'.format(file_path, str(e)))
+
+                return load_fasta(file_path)
+
+            sequences = self.stored_sequences(file_path)
+
+        # Duplicate alleles are numbered in the order of the dict
+        # parse_fasta returns, filled in file order same as here
+        return dict(sequences.iteritems())
+
+    def stored_sequences(self, file_path):
+        # A copy of the file that can be indexed, kept in the
+        # cache so that every job and process maps the same one
+        def builder(directory):
+            stored_fasta(file_path, directory, name='sequences.fasta')
+
+        entry = cached_build(os.path.join(self._cache_dir, 'fasta'),
+            hash_files([file_path]), builder)
+
+        return IndexedFasta(os.path.join(entry, 'sequences.fasta'))
+
     @property
     def sequences(self):
         return self._sequences
@@ -162,6 +421,10 @@ class DbInfo(object):
     def notes(self):
         return self._notes
 
+    @property
+    def dedupe(self):
+        return self._dedupe
+
     def export_sequences(self, filepath):
 
         # Make sure the directory exists
@@ -171,7 +434,11 @@ class DbInfo(object):
         with open(filepath, 'w') as f:
 
             for seq_id, seq_info in self._sequences.iteritems():
-                
+
+                # The representative is written for all of them
+                if seq_id in self._duplicates:
+                    continue
+
                 # The fasta file should look like:
                 # 
                 # >allele_id|1234
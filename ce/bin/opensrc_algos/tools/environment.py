@@ -414,6 +414,12 @@ class Environment(object):
     def tempdir(self):
         return self._tempdir
 
+    @property
+    def cachedir(self):
+        # Things that are expensive to build and can be
+        # reused across jobs go here
+        return os.path.join(self._shareddir, 'cache')
+
 class SingleWriteFileHandler(logging.FileHandler):
     """
     This class is to be used in order to write to
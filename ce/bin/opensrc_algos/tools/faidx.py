@@ -0,0 +1,362 @@
+###################################################################
+#
+# Indexed fasta files (samtools faidx compatible) that are read
+# straight from disk instead of being loaded into memory
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import os
+import mmap
+from collections import OrderedDict, namedtuple
+
+from .environment import (
+    log_message,
+    log_warning
+)
+
+# One line of a .fai file
+FaiEntry = namedtuple('FaiEntry', [
+    'name',
+    'length',
+    'offset',
+    'linebases',
+    'linewidth'
+])
+
+def build_fasta_index(lines):
+    """
+    Builds the .fai entries for the lines of a fasta file. Raises a
+    RuntimeError if the file can't be indexed, i.e. the lines of a
+    record are not all the same length or have whitespace in them.
+    """
+
+    entries = []
+
+    # Where we are in the file
+    position = 0
+
+    # The record being indexed
+    name = None
+    length = offset = linebases = linewidth = 0
+
+    # Set once a line shorter than the rest is found,
+    # that has to be the last line of the record
+    short = False
+
+    for line in lines:
+
+        line_start = position
+        position += len(line)
+
+        if line.startswith('>'):
+
+            if name is not None:
+                entries.append(FaiEntry(name, length, offset, linebases, linewidth))
+
+            # Same naming as fasta_iterator
+            name = line[1:].split()[0]
+            length = linebases = linewidth = 0
+            offset = position
+            short = False
+
+            continue
+
+        bases = line.rstrip('\r\n')
+
+        if not bases:
+            # Blank lines are only allowed between records
+            if line_start == offset:
+                offset = position
+                continue
+
+            short = True
+            continue
+
+        if name is None or len(bases.split()) != 1 or \
+            len(bases.strip()) != len(bases):
+
+            raise RuntimeError('Fasta file cannot be indexed')
+
+        if short:
+            raise RuntimeError('Fasta file lines are not all the same length')
+
+        if not linebases:
+            linebases = len(bases)
+            linewidth = len(line)
+
+        elif len(bases) > linebases or len(line) - len(bases) != \
+            linewidth - linebases:
+
+            raise RuntimeError('Fasta file lines are not all the same length')
+
+        if len(bases) < linebases or len(line) != linewidth:
+            short = True
+
+        length += len(bases)
+
+    if name is not None:
+        entries.append(FaiEntry(name, length, offset, linebases, linewidth))
+
+    return entries
+
+def read_fasta_index(index_path):
+
+    entries = []
+
+    with open(index_path, 'r') as f:
+
+        for line in f:
+
+            parts = line.rstrip('\n').split('\t')
+
+            entries.append(FaiEntry(
+                parts[0],
+                int(parts[1]),
+                int(parts[2]),
+                int(parts[3]),
+                int(parts[4])
+            ))
+
+    return entries
+
+def write_fasta_index(entries, index_path):
+
+    with open(index_path, 'w') as f:
+
+        for entry in entries:
+            f.write('\t'.join(map(str, entry)) + '\n')
+
+def write_fasta_records(records, fasta_path):
+    """
+    Writes (name, sequence) records with each sequence on one line,
+    which can always be indexed, along with its .fai. Returns the
+    index entries
+    """
+
+    entries = []
+    position = 0
+
+    with open(fasta_path, 'wb') as f:
+
+        for name, sequence in records:
+
+            header = '>{}\n'.format(name)
+            sequence = str(sequence)
+
+            f.write(header)
+            f.write(sequence)
+            f.write('\n')
+
+            position += len(header)
+
+            entries.append(FaiEntry(name, len(sequence), position,
+                len(sequence), len(sequence) + 1))
+
+            position += len(sequence) + 1
+
+    write_fasta_index(entries, fasta_path + '.fai')
+
+    return entries
+
+# Files that have been memory mapped, each file
+# only gets mapped once per process
+_MAPPED = {}
+
+def map_file(path):
+    # Read-only map of the whole file
+    if path in _MAPPED:
+        return _MAPPED[path]
+
+    real_path = os.path.realpath(path)
+
+    if real_path not in _MAPPED:
+
+        with open(path, 'rb') as f:
+
+            if os.fstat(f.fileno()).st_size:
+                _MAPPED[real_path] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            else:
+                _MAPPED[real_path] = ''
+
+    # Found under either name next time
+    _MAPPED[path] = _MAPPED[real_path]
+
+    return _MAPPED[path]
+
+def fasta_sequence(path, *entry):
+    # A FastaSequence back from a pickle, or for
+    # anything else that has the index entry
+    return FastaSequence(map_file(path), FaiEntry(*entry), path)
+
+class FastaSequence(object):
+    """
+    One record of an IndexedFasta. Behaves like the sequence string
+    for len() and slicing, only the slices asked for get read.
+
+    Pickling one only stores the file path and index entry.
+    """
+
+    __slots__ = ('_data', '_entry', '_path')
+
+    def __init__(self, data, entry, path=None):
+        self._data = data
+        self._entry = entry
+        self._path = path
+
+    def __reduce__(self):
+
+        if self._path is None:
+            raise TypeError('FastaSequence without a path cannot be pickled')
+
+        return fasta_sequence, (self._path,) + tuple(self._entry)
+
+    def _byte_offset(self, position):
+        entry = self._entry
+        lines, column = divmod(position, entry.linebases)
+        return entry.offset + lines * entry.linewidth + column
+
+    def __len__(self):
+        return self._entry.length
+
+    def __getitem__(self, key):
+
+        if isinstance(key, slice):
+
+            start, stop, step = key.indices(self._entry.length)
+
+            if step != 1:
+                return str(self)[key]
+
+            if stop <= start:
+                return ''
+
+            raw = self._data[self._byte_offset(start):self._byte_offset(stop-1)+1]
+
+            # Sequences are upper case, like fasta_iterator
+            return raw.translate(None, '\r\n').upper()
+
+        if key < 0:
+            key += self._entry.length
+
+        if not 0 <= key < self._entry.length:
+            raise IndexError('Sequence index out of range')
+
+        return self._data[self._byte_offset(key)].upper()
+
+    def __str__(self):
+        return self[0:self._entry.length]
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'FastaSequence({}, {})'.format(self._entry.name, self._entry.length)
+
+    @property
+    def name(self):
+        return self._entry.name
+
+class IndexedFasta(object):
+    """
+    Read-only, dict-like access to the records of a fasta file through
+    its .fai index. The file is memory mapped, so the sequences are
+    never all loaded, and separate processes share the same pages.
+
+    The index is read from fasta_path + '.fai' if it is up to date,
+    otherwise it is built (and written if possible). With write_index
+    off, the .fai is left alone and the index is only built in memory.
+
+    Pickling one only stores the path and the index, so other
+    processes that get it map the same file instead of a copy.
+    """
+
+    def __init__(self, fasta_path, write_index=True, entries=None):
+
+        self._path = fasta_path
+
+        index_path = fasta_path + '.fai'
+
+        if entries is not None:
+            pass
+
+        elif write_index and os.path.exists(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(fasta_path):
+
+            entries = read_fasta_index(index_path)
+
+        else:
+            log_message('Indexing fasta file: {}'.format(fasta_path))
+
+            with open(fasta_path, 'rb') as f:
+                entries = build_fasta_index(f)
+
+            try:
+                if write_index:
+                    write_fasta_index(entries, index_path)
+
+            except (IOError, OSError):
+                log_warning('Could not write fasta index: {}'.format(
+                    index_path))
+
+        self._data = map_file(fasta_path)
+
+        # Later records win, same as building a dict
+        self._records = OrderedDict()
+
+        for entry in entries:
+            self._records[entry.name] = FastaSequence(
+                self._data, entry, fasta_path)
+
+    def __reduce__(self):
+        return IndexedFasta, (self._path, False, [sequence._entry for \
+            sequence in self._records.itervalues()])
+
+    @property
+    def path(self):
+        return self._path
+
+    def lengths(self):
+        return dict((name, len(sequence)) for \
+            name, sequence in self._records.iteritems())
+
+    def get(self, name, default=None):
+        return self._records.get(name, default)
+
+    def __getitem__(self, name):
+        return self._records[name]
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def keys(self):
+        return self._records.keys()
+
+    def iterkeys(self):
+        return self._records.iterkeys()
+
+    def itervalues(self):
+        return self._records.itervalues()
+
+    def iteritems(self):
+        return self._records.iteritems()
+
+    def values(self):
+        return self._records.values()
+
+    def items(self):
+        return self._records.items()
@@ -0,0 +1,73 @@
+###################################################################
+#
+# Compares the line by line and the block based fasta parsers
+#
+# Run from opensrc_algos:
+#   python -m tools.fasta_benchmark genome.fasta database.fasta ...
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import os
+import sys
+import time
+
+from .tools import (
+    fasta_iterator,
+    fasta_records
+)
+
+def line_parser(path):
+    with open(path, 'r') as f:
+        return list(fasta_records(f))
+
+def block_parser(path):
+    return list(fasta_iterator(path))
+
+def time_parser(parser, path, repeat):
+    # Best of the runs, the first one warms up the page cache
+    best = None
+    records = None
+
+    for _ in xrange(repeat):
+
+        start = time.time()
+        records = parser(path)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, records
+
+def benchmark(path, repeat=3):
+
+    size = os.path.getsize(path) / float(1 << 20)
+
+    print('{} ({:.1f} MB)'.format(path, size))
+
+    results = {}
+
+    for name, parser in (('lines', line_parser), ('blocks', block_parser)):
+
+        elapsed, records = time_parser(parser, path, repeat)
+        results[name] = records
+
+        elapsed = max(elapsed, 1e-9)
+
+        print('  {:<8}{:>10.3f} s{:>14.0f} records/s{:>10.1f} MB/s'.format(
+            name, elapsed, len(records) / elapsed, size / elapsed))
+
+    if results['lines'] != results['blocks']:
+        raise RuntimeError('Parsers disagree on: {}'.format(path))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python -m tools.fasta_benchmark <fasta> [<fasta> ...]')
+
+    for path in sys.argv[1:]:
+        benchmark(path)
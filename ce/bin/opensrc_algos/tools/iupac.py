@@ -0,0 +1,120 @@
+###################################################################
+#
+# Vectorized comparisons of IUPAC nucleotide sequences
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import numpy as np
+
+from .tools import (
+    _NUC_SIBLINGS
+)
+
+# Bit for each of the bases
+_BASE_BITS = {'A': 1, 'C': 2, 'G': 4, 'T': 8}
+
+# Bitmask of every character, 0 for anything that
+# isn't an IUPAC code
+_MASKS = np.zeros(256, dtype=np.uint8)
+
+for code, bases in _NUC_SIBLINGS.iteritems():
+    _MASKS[ord(code)] = sum(_BASE_BITS[base] for base in bases)
+
+# Whether the mask is a single base
+_SINGLE = np.array([mask in (1, 2, 4, 8) for mask in range(16)])
+
+def _as_array(sequence):
+    if not sequence:
+        return np.empty(0, dtype=np.uint8)
+
+    return np.frombuffer(sequence, dtype=np.uint8)
+
+def count_mismatches(pairs):
+    """
+    The number of mismatches between each pair of sequences, the same
+    as check_mismatches. Positions past the end of the shorter sequence
+    are ignored. Two positions match if they are the same character or
+    one of them is a base that the other IUPAC code stands for.
+
+    Like check_mismatches, a KeyError is raised if two characters
+    differ and either of them isn't an IUPAC code.
+    """
+
+    first = []
+    second = []
+    lengths = []
+
+    for seq1, seq2 in pairs:
+
+        seq1 = str(seq1)
+        seq2 = str(seq2)
+
+        length = min(len(seq1), len(seq2))
+
+        first.append(seq1[:length])
+        second.append(seq2[:length])
+        lengths.append(length)
+
+    if not lengths:
+        return []
+
+    chars1 = _as_array(''.join(first))
+    chars2 = _as_array(''.join(second))
+
+    masks1 = _MASKS[chars1]
+    masks2 = _MASKS[chars2]
+
+    differ = chars1 != chars2
+
+    unknown = differ & ((masks1 == 0) | (masks2 == 0))
+
+    if unknown.any():
+        position = np.flatnonzero(unknown)[0]
+        raise KeyError(chr(chars1[position]) if not masks1[position] \
+            else chr(chars2[position]))
+
+    mismatch = differ & ~(((masks1 & masks2) != 0) & \
+        (_SINGLE[masks1] | _SINGLE[masks2]))
+
+    # Mismatches per pair from the running total
+    totals = np.zeros(len(mismatch) + 1, dtype=np.int64)
+    np.cumsum(mismatch, out=totals[1:])
+
+    ends = np.cumsum(lengths)
+
+    return (totals[ends] - totals[ends - lengths]).tolist()
+
+def window_mismatches(sequence, pattern):
+    """
+    The number of mismatches between the pattern and every window of
+    the sequence as long as it, by where the window starts. Same rules
+    as count_mismatches, except that two characters that differ and
+    aren't both IUPAC codes count as a mismatch instead of raising
+    """
+
+    chars = _as_array(str(sequence))
+    masks = _MASKS[chars]
+
+    count = len(chars) - len(pattern) + 1
+
+    if count <= 0:
+        return np.empty(0, dtype=np.int32)
+
+    totals = np.zeros(count, dtype=np.int32)
+
+    for i, nuc in enumerate(pattern):
+
+        window = chars[i:i+count]
+        window_masks = masks[i:i+count]
+        mask = _MASKS[ord(nuc)]
+
+        match = (window == ord(nuc)) | (((window_masks & mask) != 0) & \
+            (_SINGLE[window_masks] | _SINGLE[mask]))
+
+        totals += ~match
+
+    return totals
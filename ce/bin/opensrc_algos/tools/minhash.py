@@ -0,0 +1,83 @@
+###################################################################
+#
+# MinHash sketches of genomes, for a quick estimate of how
+# close two genomes are
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import numpy as np
+
+from .tools import (
+    fasta_iterator
+)
+
+from .packed import (
+    PackedSequence
+)
+
+from .dbinfo import (
+    code_identity,
+    loader_identity
+)
+
+_KMER_SIZE = 21
+_SKETCH_SIZE = 1000
+
+def mix(values):
+    # The splitmix64 finalizer, spreads the k-mer codes
+    # evenly over 64 bits
+    values = values.copy()
+
+    with np.errstate(over='ignore'):
+        values ^= values >> np.uint64(30)
+        values *= np.uint64(0xbf58476d1ce4e5b9)
+        values ^= values >> np.uint64(27)
+        values *= np.uint64(0x94d049bb133111eb)
+        values ^= values >> np.uint64(31)
+
+    return values
+
+def sketch_sequences(sequences, k=_KMER_SIZE, size=_SKETCH_SIZE):
+    """
+    The size smallest hashes of the canonical k-mers of the
+    sequences, sorted. K-mers with anything other than
+    A, C, G or T in them are left out
+    """
+
+    hashes = []
+
+    for sequence in sequences:
+        _, values = PackedSequence(sequence.upper()).kmers(k, canonical=True)
+        hashes.append(np.unique(mix(values))[:size])
+
+    if not hashes:
+        return np.empty(0, dtype=np.uint64)
+
+    return np.unique(np.concatenate(hashes))[:size]
+
+def sketch_fasta(path, k=_KMER_SIZE, size=_SKETCH_SIZE):
+    return sketch_sequences(
+        (sequence for _, sequence in fasta_iterator(path)), k, size)
+
+def sketch_identity():
+    # Everything that decides what a sketch comes out as, sketches
+    # made any other way can't be compared to these
+    return [_KMER_SIZE, _SKETCH_SIZE] + [code_identity(f) for f in \
+        (mix, sketch_sequences, sketch_fasta)] + loader_identity(PackedSequence)
+
+def jaccard(sketch1, sketch2, size=_SKETCH_SIZE):
+    # Estimate of the Jaccard index of the k-mers that
+    # the two sketches were made from
+    union = np.union1d(sketch1, sketch2)[:size]
+
+    if not len(union):
+        return 0.0
+
+    shared = np.intersect1d(sketch1, sketch2, assume_unique=True)
+
+    return float(len(np.intersect1d(union, shared, assume_unique=True))) / \
+        float(len(union))
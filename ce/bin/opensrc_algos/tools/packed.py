@@ -0,0 +1,222 @@
+###################################################################
+#
+# Nucleotide sequences packed into 2 bits per base
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import numpy as np
+
+from .tools import (
+    reverse_complement
+)
+
+# A, C, G and T are packed, anything else (IUPAC codes,
+# lower case, gaps) is kept aside as is
+_BASES = 'ACGT'
+_OTHER = 4
+
+_CODES = np.full(256, _OTHER, dtype=np.uint8)
+
+for code, base in enumerate(_BASES):
+    _CODES[ord(base)] = code
+
+_LETTERS = np.frombuffer(_BASES, dtype=np.uint8)
+
+# Bit offsets of the four bases within a byte,
+# the first base takes the high bits
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+def _as_array(sequence):
+    # The bytes of the string, older numpy won't take an empty one
+    if not sequence:
+        return np.empty(0, dtype=np.uint8)
+
+    return np.frombuffer(sequence, dtype=np.uint8)
+
+def _pack(codes):
+    # Four codes to a byte
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+
+    return np.bitwise_or.reduce(
+        padded.reshape(-1, 4) << _SHIFTS, axis=1).astype(np.uint8)
+
+class PackedSequence(object):
+    """
+    A nucleotide sequence stored at 2 bits per base, with a list of
+    the positions that aren't A, C, G or T and what they were. The
+    str() of it is exactly the sequence it was made from.
+
+    Indexing and slicing give back plain strings like they would on
+    the original sequence, subsequence() and reverse_complement()
+    stay packed.
+    """
+
+    __slots__ = ('_packed', '_length', '_other_pos', '_other')
+
+    def __init__(self, sequence=''):
+
+        chars = _as_array(sequence)
+        codes = _CODES[chars]
+
+        other_pos = np.flatnonzero(codes == _OTHER)
+        codes[other_pos] = 0
+
+        self._set(_pack(codes), len(sequence), other_pos,
+            chars[other_pos].tostring())
+
+    def _set(self, packed, length, other_pos, other):
+        self._packed = packed
+        self._length = length
+        self._other_pos = other_pos
+        self._other = other
+
+    @classmethod
+    def _from_codes(cls, codes, other_pos, other):
+        packed = cls.__new__(cls)
+        packed._set(_pack(codes), len(codes), other_pos, other)
+        return packed
+
+    def codes(self, start=0, stop=None):
+        # The 2 bit codes from start to stop, the positions
+        # that aren't A, C, G or T come back as 0
+        if stop is None:
+            stop = self._length
+
+        first = start // 4
+        last = -(-stop // 4)
+
+        unpacked = (self._packed[first:last, None] >> _SHIFTS) & 3
+
+        return unpacked.ravel()[start - first*4:stop - first*4]
+
+    def _others(self, start, stop):
+        lo = np.searchsorted(self._other_pos, start)
+        hi = np.searchsorted(self._other_pos, stop)
+        return self._other_pos[lo:hi], self._other[lo:hi]
+
+    def _decode(self, start, stop):
+
+        if stop <= start:
+            return ''
+
+        chars = _LETTERS[self.codes(start, stop)]
+
+        positions, other = self._others(start, stop)
+        chars[positions - start] = _as_array(other)
+
+        return chars.tostring()
+
+    def subsequence(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(self._length)
+        stop = max(start, stop)
+
+        positions, other = self._others(start, stop)
+
+        return PackedSequence._from_codes(
+            self.codes(start, stop), positions - start, other)
+
+    def reverse_complement(self):
+
+        codes = self.codes()[::-1] ^ 3
+        positions = (self._length - 1) - self._other_pos[::-1]
+
+        # Same as complementing the string
+        return PackedSequence._from_codes(
+            codes, positions, reverse_complement(self._other))
+
+    def kmers(self, k, canonical=False):
+        """
+        The k-mers (k <= 32) of the sequence as 2 bit encoded integers,
+        along with the positions they start at. Any k-mer that has
+        something other than A, C, G or T in it is left out. With
+        canonical set, the smaller of each k-mer and its reverse
+        complement is returned
+        """
+
+        if not 0 < k <= 32:
+            raise ValueError('K-mers can only be between 1 and 32 long')
+
+        count = self._length - k + 1
+
+        if count <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+
+        codes = self.codes().astype(np.uint64)
+        values = np.zeros(count, dtype=np.uint64)
+
+        for i in xrange(k):
+            values = (values << np.uint64(2)) | codes[i:i+count]
+
+        if canonical:
+            reverse = np.zeros(count, dtype=np.uint64)
+
+            for i in xrange(k):
+                reverse |= (np.uint64(3) - codes[i:i+count]) << np.uint64(2*i)
+
+            values = np.minimum(values, reverse)
+
+        others = np.zeros(self._length + 1, dtype=np.int64)
+        others[self._other_pos + 1] = 1
+        others = np.cumsum(others)
+
+        positions = np.flatnonzero(others[k:] == others[:count])
+
+        return positions, values[positions]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+
+        if isinstance(key, slice):
+
+            start, stop, step = key.indices(self._length)
+
+            if step != 1:
+                return str(self)[key]
+
+            return self._decode(start, stop)
+
+        if key < 0:
+            key += self._length
+
+        if not 0 <= key < self._length:
+            raise IndexError('Sequence index out of range')
+
+        return self._decode(key, key+1)
+
+    def __str__(self):
+        return self._decode(0, self._length)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PackedSequence({})'.format(self._length)
+
+    @property
+    def nbytes(self):
+        return self._packed.nbytes + self._other_pos.nbytes + len(self._other)
+
+def pack_kmer(kmer):
+    # The same 2 bit integer kmers() gives for a k-mer
+    # of only A, C, G and T
+    value = 0
+
+    for base in kmer:
+        value = (value << 2) | _BASES.index(base)
+
+    return np.uint64(value)
+
+def pack_sequences(sequences):
+    # Packs the values of a dict of sequences
+    return dict((name, PackedSequence(sequence)) for \
+        name, sequence in sequences.iteritems())
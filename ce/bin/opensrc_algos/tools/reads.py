@@ -0,0 +1,336 @@
+###################################################################
+#
+# Tools for streaming through raw read files
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import io
+import os
+import gzip
+import random
+from itertools import izip_longest, islice, chain
+
+from .tools import (
+    check_gzipped,
+    fasta_iterator,
+    reverse_complement
+)
+
+from .unpack import (
+    unpack_files
+)
+
+from .environment import (
+    log_message,
+    log_warning,
+    valid_dir
+)
+
+# Number of pairs read up front to estimate
+# the size of the whole run
+_ESTIMATE_PAIRS = 10000
+
+def open_reads(path):
+    # Read files can come in gzipped or not, either way
+    # we get back something we can readline() quickly
+    if check_gzipped(path):
+        return io.BufferedReader(gzip.open(path, 'rb'))
+
+    return open(path, 'rb')
+
+def reads_basename(path):
+    # The name of the read file without any .gz
+    name = os.path.basename(path)
+
+    if name.endswith('.gz'):
+        name = name[:-3]
+
+    return name
+
+def plain_reads(read_files, out_dir, threads=1):
+    """
+    For the tools that can't read gzip themselves. Gzipped read
+    files are unpacked into out_dir, up to threads at a time,
+    everything else is returned as is
+    """
+
+    out_paths = []
+    jobs = []
+
+    for path in read_files:
+
+        if not check_gzipped(path):
+            out_paths.append(path)
+            continue
+
+        valid_dir(out_dir)
+
+        out_path = os.path.join(out_dir, reads_basename(path))
+
+        jobs.append((path, out_path))
+        out_paths.append(out_path)
+
+    unpack_files(jobs, threads=threads)
+
+    return out_paths
+
+def fastq_iterator(flobj):
+    # Files look like this:
+    #
+    # @read_id
+    # ACTGACTGACTGACTGACTGACTGACTG
+    # +
+    # IIIIIIIIIIIIIIIIIIIIIIIIIIII
+    #
+    # The four lines of each record are returned untouched
+    # so they can be written back out as is
+
+    while True:
+
+        header = flobj.readline()
+
+        if not header:
+            return
+
+        sequence = flobj.readline()
+        separator = flobj.readline()
+        quality = flobj.readline()
+
+        if not quality:
+            raise RuntimeError('Truncated fastq record: {}'.format(
+                header.strip()))
+
+        yield header, sequence, separator, quality
+
+def paired_records(first, second):
+    # Walks both mates of the pairs at the same time
+    for pair in izip_longest(fastq_iterator(first), fastq_iterator(second)):
+
+        if pair[0] is None or pair[1] is None:
+            raise RuntimeError('Paired read files have a different'
+                ' number of reads')
+
+        yield pair
+
+def paired_fastq_iterator(read_files):
+
+    if len(read_files) != 2:
+        raise RuntimeError('Paired reads must be provided as two files')
+
+    first = open_reads(read_files[0])
+    second = open_reads(read_files[1])
+
+    try:
+        for pair in paired_records(first, second):
+            yield pair
+
+    finally:
+        first.close()
+        second.close()
+
+def disk_offset(flobj):
+    # How far into the file on disk we are, for gzipped
+    # files this is in compressed bytes
+    if isinstance(flobj, io.BufferedReader):
+        return flobj.raw.fileobj.tell()
+
+    return flobj.tell()
+
+def subsample_reads(read_files, out_dir, target_bases, seed=0):
+    """
+    Streams through the paired reads once and keeps each pair with
+    the probability needed to end up with about target_bases. The
+    size of the run is estimated from the first pairs and the size
+    of the file on disk, so nothing needs to be read twice. Both
+    mates are always kept or dropped together, and the same seed
+    always picks the same pairs.
+
+    Returns the paths of the subsampled read files, or the original
+    paths if there is nothing to drop
+    """
+
+    if len(read_files) != 2:
+        raise RuntimeError('Paired reads must be provided as two files')
+
+    first = open_reads(read_files[0])
+    second = open_reads(read_files[1])
+
+    try:
+        records = paired_records(first, second)
+        head = list(islice(records, _ESTIMATE_PAIRS))
+
+        head_bases = sum(len(record_1[1].rstrip()) + \
+            len(record_2[1].rstrip()) for record_1, record_2 in head)
+
+        if len(head) < _ESTIMATE_PAIRS:
+            total_bases = head_bases
+
+        else:
+            total_bases = head_bases * \
+                float(os.path.getsize(read_files[0])) / \
+                max(1, disk_offset(first))
+
+        fraction = target_bases / max(1.0, total_bases)
+
+        log_message('Estimated {} bases of reads, target is {}'.format(
+            int(total_bases), int(target_bases)))
+
+        if fraction >= 1.:
+            log_message('Not enough reads to subsample')
+            return list(read_files)
+
+        valid_dir(out_dir)
+
+        out_paths = [os.path.join(out_dir, reads_basename(path)) \
+            for path in read_files]
+
+        if out_paths[0] == out_paths[1]:
+            raise RuntimeError('Paired read files must have different names')
+
+        sampler = random.Random(seed)
+
+        total = 0
+        kept = 0
+
+        with open(out_paths[0], 'wb') as out_1, \
+            open(out_paths[1], 'wb') as out_2:
+
+            for record_1, record_2 in chain(head, records):
+
+                total += 1
+
+                if sampler.random() < fraction:
+                    out_1.writelines(record_1)
+                    out_2.writelines(record_2)
+                    kept += 1
+
+        log_message('Kept {} of {} read pairs'.format(kept, total))
+
+        return out_paths
+
+    finally:
+        first.close()
+        second.close()
+
+def genome_size(settings):
+    # The length of the assembly if there is one, otherwise
+    # whatever the genotyper was configured with
+    if settings.cached_query:
+        return sum(len(sequence) for sequence in \
+            settings.cached_query.itervalues())
+
+    if settings['genome_size']:
+        return int(settings['genome_size'])
+
+    return None
+
+def target_coverage_reads(settings, env):
+    """
+    Subsamples settings.query_reads down to the target_coverage
+    setting. Returns the read files to use, which are the original
+    ones when no target was configured
+    """
+
+    if not settings['target_coverage']:
+        return settings.query_reads
+
+    size = genome_size(settings)
+
+    if not size:
+        log_warning('No genome size available, not subsampling reads')
+        return settings.query_reads
+
+    log_message('Subsampling reads to {}x coverage...'.format(
+        settings['target_coverage']))
+
+    return subsample_reads(
+        settings.query_reads,
+        os.path.join(env.localdir, 'subsampled'),
+        float(settings['target_coverage']) * size,
+        seed=settings['subsample_seed'] or 0
+    )
+
+def kmer_set(sequences, k):
+    # Every k-mer of the sequences on both strands so that
+    # reads don't need to be reverse complemented
+    kmers = set()
+
+    for sequence in sequences:
+
+        for strand in (sequence, reverse_complement(sequence)):
+
+            for i in xrange(len(strand) - k + 1):
+                kmers.add(strand[i:i+k])
+
+    return kmers
+
+def shares_kmer(sequence, kmers, k, step):
+    # Only every step-th k-mer gets looked up, any stretch of
+    # k + step - 1 bases shared with the references will still
+    # be found
+    last = len(sequence) - k
+
+    for i in xrange(0, last + 1, step):
+        if sequence[i:i+k] in kmers:
+            return True
+
+    # The end of the read, in case the steps jumped over it
+    if last > 0 and last % step:
+        return sequence[last:] in kmers
+
+    return False
+
+def kmer_prefilter(read_files, reference, out_dir, k=21, step=5):
+    """
+    Streams through the paired reads and writes out only the pairs
+    where either mate shares a k-mer with the reference sequences.
+    Meant for mapping whole genome runs against a tiny panel
+    where almost none of the reads can map anyway.
+
+    Returns the paths of the filtered read files
+    """
+
+    if not isinstance(reference, basestring) or not \
+        os.path.exists(reference):
+
+        raise RuntimeError('Invalid reference file provided: {}'.format(
+            str(reference)))
+
+    kmers = kmer_set(
+        (sequence for _, sequence in fasta_iterator(reference)), k)
+
+    log_message('Screening reads with {} reference {}-mers'.format(
+        len(kmers), k))
+
+    valid_dir(out_dir)
+
+    out_paths = [os.path.join(out_dir, reads_basename(path)) \
+        for path in read_files]
+
+    if out_paths[0] == out_paths[1]:
+        raise RuntimeError('Paired read files must have different names')
+
+    total = 0
+    kept = 0
+
+    with open(out_paths[0], 'wb') as first, \
+        open(out_paths[1], 'wb') as second:
+
+        for record_1, record_2 in paired_fastq_iterator(read_files):
+
+            total += 1
+
+            if shares_kmer(record_1[1].rstrip(), kmers, k, step) or \
+                shares_kmer(record_2[1].rstrip(), kmers, k, step):
+
+                first.writelines(record_1)
+                second.writelines(record_2)
+                kept += 1
+
+    log_message('Kept {} of {} read pairs'.format(kept, total))
+
+    return out_paths
@@ -15,6 +15,9 @@ from .tools import (
     popen,
     parse_paired_files
 )
+from .cmdline_tools import (
+    popen_pipeline
+)
 from .environment import (
     log_message,
     log_error,
@@ -24,9 +27,13 @@ from .environment import (
 )
 
 from .bowtie import (
-    bowtie_index
+    paired_bowtie2_args
 )
 
+# Memory given to samtools sort for every slot
+# of the job, in megabytes
+_SORT_MEMORY_PER_SLOT = 512
+
 class SamtoolsFilter(object):
     """
     Use this class to create filter objects for sam files to pass to
@@ -235,6 +242,139 @@ def bam_sort(bam_file, env):
 
     return bam_sorted_path
 
+def paired_bowtie2_sorted(read_files, env, index_path='', reference=''):
+    """
+    Maps paired reads with bowtie2 and streams the alignments
+    through samtools into a sorted, indexed bam file:
+
+        bowtie2 | samtools view -u | samtools sort -@N -m MEM
+
+    so that no SAM or unsorted BAM copies ever touch the disk.
+    Returns the path of the sorted bam file
+    """
+
+    # bowtie2 and sort run at the same time, so they split the
+    # threads bowtie2 would have had on its own, most go to bowtie2
+    threads = max(1, env.threads - 1)
+    sort_threads = max(1, threads // 4)
+
+    bowtie2_args = paired_bowtie2_args(
+        read_files,
+        env,
+        index_path=index_path,
+        reference=reference,
+        threads=max(1, threads - sort_threads)
+    )
+
+    samtools_path = full_path(
+        os.path.join(
+            env.toolsdir,
+            'all_tools',
+            'samtools'
+        )
+    )
+
+    if not os.path.exists(samtools_path):
+        raise RuntimeError('Missing samtools executable')
+
+    output_dir = full_path(
+        os.path.join(env.localdir, 'bowtie')
+    )
+
+    valid_dir(output_dir)
+
+    bam_sorted_path = os.path.join(output_dir, 'output.sorted.bam')
+
+    # This is per sort thread
+    sort_memory = max(
+        100, (_SORT_MEMORY_PER_SLOT * env.threads) // sort_threads)
+
+    view_args = [
+        samtools_path,
+        'view',
+        # Uncompressed bam, no reason to compress a pipe
+        '-u',
+        '-'
+    ]
+
+    sort_args = [
+        samtools_path,
+        'sort',
+        '-@', str(sort_threads),
+        '-m', '{}M'.format(sort_memory),
+        '-T', os.path.join(output_dir, 'output_intermediate'),
+        '-o', bam_sorted_path,
+        '-'
+    ]
+
+    stages = ['bowtie2', 'samtools view', 'samtools sort']
+    commands = [bowtie2_args, view_args, sort_args]
+
+    for stage, cmd_args in zip(stages, commands):
+        log_message('Running {} args: {}'.format(
+            stage, ' '.join(cmd_args)))
+
+    results = popen_pipeline(commands, cwd=output_dir)
+
+    failed = []
+
+    for stage, (return_code, err) in zip(stages, results):
+        if return_code:
+            log_error('{} exited with {}: {}'.format(
+                stage, return_code, err.strip()))
+
+            failed.append(stage)
+
+    if failed:
+        raise RuntimeError('Error running mapping pipeline,'
+            ' failed stages: {}'.format(', '.join(failed)))
+
+    if not os.path.exists(bam_sorted_path):
+        raise RuntimeError('Missing sorted bam file')
+
+    bam_index(bam_sorted_path, env)
+
+    return bam_sorted_path
+
+def bam_index(bam_file, env):
+
+    if not isinstance(bam_file, basestring) or not \
+        os.path.exists(bam_file):
+        raise RuntimeError('Invalid bam file provided')
+
+    samtools_path = full_path(
+        os.path.join(
+            env.toolsdir,
+            'all_tools',
+            'samtools'
+        )
+    )
+
+    if not os.path.exists(samtools_path):
+        raise RuntimeError('Missing samtools executable')
+
+    cmd_args = [
+        samtools_path,
+        'index',
+        bam_file
+    ]
+
+    log_message('Running samtools index args: {}'.format(
+        ' '.join(cmd_args)))
+
+    return_code, out, err = popen(cmd_args)
+
+    if return_code:
+        log_error(err.strip())
+        raise RuntimeError('Error running samtools index')
+
+    index_path = bam_file + '.bai'
+
+    if not os.path.exists(index_path):
+        raise RuntimeError('Missing bam index file')
+
+    return index_path
+
 def pile_up_sam(bam_sorted, reference, env):
 
     if not isinstance(bam_sorted, basestring) or not \
@@ -247,16 +387,15 @@ def pile_up_sam(bam_sorted, reference, env):
 
         raise RuntimeError('Invalid reference file')
 
-    # We want to make sure that the sorted bam file has been indexed
-    sorted_index_name = os.path.basename(bam_sorted).split('.')[0]
+    # We want to make sure that the sorted bam file has been indexed,
+    # since it was last written
+    index_path = bam_sorted + '.bai'
 
-    index_path = bowtie_index(bam_sorted, env, name=sorted_index_name)
-    parent_dir = index_path
+    if not os.path.exists(index_path) or \
+        os.path.getmtime(bam_sorted) > os.path.getmtime(index_path):
+        bam_index(bam_sorted, env)
 
-    # This will be the bowtie2 dir that is created
-    # in the local dir
-    for _ in range(2):
-        parent_dir = os.path.dirname(parent_dir)
+    parent_dir = os.path.dirname(full_path(bam_sorted))
 
     pileup_name = os.path.split(reference)[1].split('.')[0] + '.pup'
 
@@ -11,15 +11,28 @@
 
 import os
 import sys
+import shutil
+import cPickle as pickle
 import subprocess as sp
 
 from .environment import (
     log_message,
+    log_warning,
     log_error,
     valid_dir
 )
 
-from tools.tools import (
+from .cache import (
+    cached_build,
+    hash_files,
+    file_identity
+)
+
+from .dbinfo import (
+    code_identity
+)
+
+from .tools import (
     popen,
     add_cmdline_args,
     add_cmdline_kwargs
@@ -34,19 +47,190 @@ ANILine = namedtuple('ANILine', [
     'taxonomy'
 ])
 
-# TODO - Update to use popen function
-def run_ani(query, env):
-
-    log_message('Running ANI', 2)
+def ani_path():
 
     bin_path = __file__
 
     for _ in range(3):
         bin_path = os.path.dirname(bin_path)
 
-    ani_path = os.path.join(bin_path, 'ani/ani-m.pl')
+    return os.path.join(bin_path, 'ani/ani-m.pl')
+
+def ani_references_path(env):
+    return os.path.join(env.shareddir, 'ani_references', 'species.tsv')
+
+def reference_genome(references, line):
+    # The absolute path of the genome on a line of
+    # species.tsv, None if it isn't one
+    path = line.split('\t', 1)[0].strip()
+
+    if not path:
+        return None
+
+    for directory in (os.path.dirname(references),
+        os.path.dirname(os.path.realpath(references))):
+
+        full_path = os.path.join(directory, path)
+
+        if os.path.isfile(full_path):
+            return os.path.abspath(full_path)
+
+    return None
+
+def reference_sketches(references, env):
+    """
+    MinHash sketches of the genomes in species.tsv, made once for every
+    version of it (and of the sketching) and kept in the shared cache.
+    Returns a list of (line, genome path, sketch), the last two are
+    None for lines that aren't a genome
+    """
+
+    from .minhash import sketch_fasta, sketch_identity
+
+    def builder(directory):
+
+        sketches = []
+
+        with open(references, 'r') as f:
+
+            for line in f:
+
+                path = reference_genome(references, line)
+
+                sketches.append((line, path, None if path is None \
+                    else sketch_fasta(path)))
+
+        with open(os.path.join(directory, 'sketches.pkl'), 'wb') as f:
+            pickle.dump(sketches, f, pickle.HIGHEST_PROTOCOL)
+
+    entry = cached_build(os.path.join(env.cachedir, 'ani_sketches'),
+        hash_files([references], extra=sketch_identity()), builder)
+
+    with open(os.path.join(entry, 'sketches.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+def closest_references(query, references, top_references, out_path, env):
+    """
+    Writes a species.tsv to out_path with only the top_references
+    genomes closest to the query by MinHash, everything else in the
+    file is kept as is. Returns the path of the species.tsv to use,
+    the whole panel if the sketches can't be used
+    """
+
+    try:
+        from .minhash import sketch_fasta, jaccard
+
+    except ImportError:
+        log_warning('NumPy is not available, ANI will run against'
+            ' every reference')
+
+        return references
+
+    try:
+        sketches = reference_sketches(references, env)
+
+    except (IOError, OSError) as e:
+        log_warning('Could not use the ANI reference sketches: {}'.format(
+            str(e)))
+
+        return references
+
+    query_sketch = sketch_fasta(query)
+
+    scores = sorted((-jaccard(query_sketch, sketch), i) for i, \
+        (_, path, sketch) in enumerate(sketches) if sketch is not None)
+
+    keep = set(i for _, i in scores[:top_references])
+
+    with open(out_path, 'w') as f:
+
+        for i, (line, path, _) in enumerate(sketches):
+
+            if path is None:
+                f.write(line)
+
+            elif i in keep:
+                # The new file isn't next to the genomes
+                f.write(path + '\t' + line.split('\t', 1)[1] \
+                    if '\t' in line else path + '\n')
 
-    if not os.path.exists(ani_path):
+    log_message('Running ANI against the {} closest of {} references'.format(
+        len(keep), len(scores)), 2)
+
+    return out_path
+
+def preselection_identity(top_references):
+    # Everything that decides which references are kept
+    # with top_references, nothing without it
+    if not top_references:
+        return []
+
+    try:
+        from .minhash import sketch_identity
+
+    except ImportError:
+        # Every reference is kept without numpy
+        return [None]
+
+    return sketch_identity() + [code_identity(f) for f in \
+        (reference_genome, reference_sketches, closest_references)]
+
+def run_ani(query, env, top_references=None):
+
+    results = ANIParser()
+
+    results.load(path=ani_table(query, env, top_references))
+
+    return results
+
+def cached_ani(query, env, top_references=None):
+    """
+    Same as run_ani, except the raw ANI table is kept in the shared
+    cache for every unique query and species.tsv so that the query
+    can be interpreted again without rerunning ANI
+    """
+
+    if not isinstance(query, basestring) or not os.path.exists(query):
+        raise RuntimeError('Invalid query provided to run ANI')
+
+    references = ani_references_path(env)
+
+    if not os.path.exists(references):
+        raise RuntimeError('Missing ANI references in shared directory: {}'.format(
+            env.shareddir))
+
+    def builder(directory):
+        shutil.copy(ani_table(query, env, top_references),
+            os.path.join(directory, 'out.tsv'))
+
+    try:
+        # A new ani-m.pl might score things differently, new
+        # sketches might keep different references
+        key = hash_files([query, references], extra=[
+            file_identity(ani_path()), top_references] + \
+            preselection_identity(top_references))
+
+        entry = cached_build(os.path.join(env.cachedir, 'ani'), key, builder)
+
+    except (IOError, OSError) as e:
+        log_warning('Could not use the ANI cache: {}'.format(str(e)))
+
+        return run_ani(query, env, top_references)
+
+    results = ANIParser()
+
+    results.load(path=os.path.join(entry, 'out.tsv'))
+
+    return results
+
+# TODO - Update to use popen function
+def ani_table(query, env, top_references=None):
+    # Runs ANI, returns the path to the raw results table. With
+    # top_references, only against that many of the closest references
+
+    log_message('Running ANI', 2)
+
+    if not os.path.exists(ani_path()):
         raise RuntimeError('Missing ANI binary')
 
     local_dir = os.path.join(env.localdir, 'ani', 'local')
@@ -56,11 +240,7 @@ def run_ani(query, env):
         valid_dir(dirc)
 
     # Make sure that the ANI references symlink exists
-    ani_references = os.path.join(
-                        env.shareddir, 
-                        'ani_references', 
-                        'species.tsv'
-                    )
+    ani_references = ani_references_path(env)
 
     if not os.path.exists(ani_references):
         raise RuntimeError('Missing ANI references in shared directory: {}'.format(
@@ -69,15 +249,19 @@ def run_ani(query, env):
     if not isinstance(query, basestring) or not os.path.exists(query):
         raise RuntimeError('Invalid query provided to run ANI')
 
+    if top_references:
+        ani_references = closest_references(query, ani_references,
+            int(top_references), os.path.join(local_dir, 'species.tsv'), env)
+
     cmd_args = [
-        os.path.realpath(ani_path),
+        os.path.realpath(ani_path()),
         '--localdir', local_dir,
         '--resultsdir', results_dir,
         '--tempdir', env.tempdir,
         '--shareddir', env.shareddir,
         '--references', ani_references,
         '--query', query,
-        '--nThreads', str(env.threads - 1)
+        '--nThreads', str(max(1, env.threads - 1))
     ]
 
     child = sp.Popen(
@@ -119,11 +303,7 @@ def run_ani(query, env):
 
     log_message('Done running ANI!', 3)
 
-    results = ANIParser()
-
-    results.load(path=results_file)
-
-    return results
+    return results_file
 
 class ANIParser(object):
 
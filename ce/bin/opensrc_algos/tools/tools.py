@@ -9,6 +9,7 @@
 ###################################################################
 
 import base64
+import io
 import os
 import sys
 import gzip
@@ -22,12 +23,18 @@ from collections import OrderedDict, namedtuple
 
 from Bio import SeqIO
 
+from .faidx import (
+    IndexedFasta,
+    write_fasta_records
+)
+
 from .environment import (
     full_path,
     log_message,
     log_warning,
     log_exception,
-    log_error
+    log_error,
+    valid_dir
 )
 
 _FASTAEXTS = ['.fna', '.fasta', '.fsa']
@@ -37,6 +44,10 @@ _REV = 'TACGYRSWMKVHDBN'
 _COMPLEMENT = maketrans(_FWD, _REV)
 _GZIP_START = b'1f8b'
 
+# Fasta files are read this much at a time, small
+# enough for the copies to stay in the cache
+_FASTA_BLOCK_SIZE = 1 << 18
+
 # Get the codons for any particular amino acid
 _AA_BACK_TRANSLATE = {
     'A' : ['GCT', 'GCC', 'GCA', 'GCG'],
@@ -212,14 +223,122 @@ def get_all_file_exts(path):
 
     return real_root, exts
 
-def process_seq_file(file_path, load=True):
+def checked_fasta_lines(lines, file_path):
+    # Passes the lines through with \r\n turned into \n,
+    # making sure the first thing in there is a header
+    checked = False
+
+    for line in lines:
+
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+
+        if not checked and line.strip():
+
+            if line[0] != '>':
+                raise RuntimeError('Not a valid fasta file: {}'.format(
+                    file_path))
+
+            checked = True
+
+        yield line
+
+def written_lines(lines, flobj):
+    # Writes out the lines as they go by
+    for line in lines:
+        flobj.write(line)
+        yield line
+
+def unzip_fasta(file_path, out_path=None, load=True):
+    """
+    Decompresses, normalizes the newlines of, checks and parses a
+    gzipped fasta file in one go. The normalized file is only written
+    out if out_path is provided and the sequences are only kept if
+    load is set
+    """
+
+    f = io.BufferedReader(gzip.open(file_path, 'rb'))
+    out = None
+
+    try:
+        lines = checked_fasta_lines(f, file_path)
+
+        if out_path is not None:
+            out = open(out_path, 'wb')
+            lines = written_lines(lines, out)
+
+        if load:
+            return dict(fasta_records(lines))
+
+        for _ in lines:
+            pass
+
+        return None
+
+    finally:
+        f.close()
+
+        if out is not None:
+            out.close()
+
+def load_fasta(file_path, indexed=False, packed=False, store_dir=None):
+    # Either the sequences themselves, an IndexedFasta that reads
+    # them from disk when asked or the sequences packed 2 bits
+    # per base
+    if indexed and is_fasta(file_path):
+
+        try:
+            return IndexedFasta(file_path)
+
+        except RuntimeError as e:
+
+            if store_dir is not None:
+                log_message('Unable to index {}: {}, storing a copy that'
+                    ' can be indexed instead'.format(file_path, str(e)))
+
+                return stored_fasta(file_path, store_dir)
+
+            log_warning('Unable to index {}: {}, loading it instead'.format(
+                file_path, str(e)))
+
+    sequences = parse_fasta(file_path)
+
+    if packed:
+        return pack_fasta(sequences)
+
+    return sequences
+
+def stored_fasta(file_path, store_dir, name=None):
+    # An indexed copy of the fasta file in store_dir, one line per
+    # sequence. Anything that has it maps the same pages
+    valid_dir(store_dir)
+
+    store_path = os.path.join(store_dir, name or os.path.basename(file_path))
+
+    entries = write_fasta_records(fasta_iterator(file_path), store_path)
+
+    return IndexedFasta(store_path, entries=entries)
+
+def pack_fasta(sequences):
+    # Needs numpy, the sequences are left alone without it
+    try:
+        from .packed import pack_sequences
+
+    except ImportError:
+        log_warning('NumPy is not available, sequences will not be packed')
+        return sequences
+
+    return pack_sequences(sequences)
+
+def process_seq_file(file_path, load=True, write=True, indexed=False,
+    packed=False, store_dir=None):
 
     log_message('Checking provided '
                 'sequence file: {}'.format(file_path))
 
     if not os.path.exists(file_path):
         raise RuntimeError('No file exists for path: {}'
-                            ''.format(str(path)))
+                            ''.format(str(file_path)))
 
     out_path = file_path
 
@@ -235,21 +354,75 @@ def process_seq_file(file_path, load=True):
         else:
             out_path = root + '.fasta'
 
+        if load and os.path.splitext(out_path)[1] not in _FASTAEXTS:
+            raise RuntimeError('Requested file path is not of type fasta')
+
+        # Nothing needs the unpacked file
+        if not write:
+            out_path = None
+
+        # The index is built from the unpacked file
+        indexed = indexed and load and out_path is not None
+
         log_message('Unzipping...', extra=1)
         
         try:
-            unzip_file(file_path, out_path)
+            sequences = unzip_fasta(file_path, out_path, load=load and not indexed)
 
         except:
             log_error('Unable to unzip query file!')
             raise
 
+        if indexed:
+            sequences = load_fasta(out_path, indexed=True, store_dir=store_dir)
+
+        elif packed and sequences is not None:
+            sequences = pack_fasta(sequences)
+
+        return out_path, sequences
+
     if load:
-        return out_path, parse_fasta(out_path)
+        return out_path, load_fasta(out_path, indexed=indexed, packed=packed,
+            store_dir=store_dir)
 
     else:
         return out_path, None
 
+def sniff_read_file(file_path):
+    # The first character of the (uncompressed) data
+    if check_gzipped(file_path):
+        f = gzip.open(file_path, 'rb')
+
+    else:
+        f = open(file_path, 'rb')
+
+    try:
+        return f.read(1)
+
+    finally:
+        f.close()
+
+def process_read_file(file_path):
+    # Read files are large and everything downstream can
+    # read gzip, so they are only checked, never unpacked
+
+    if not os.path.exists(file_path):
+        raise RuntimeError('Read file not found: {}'.format(file_path))
+
+    try:
+        first = sniff_read_file(file_path)
+
+    except IOError:
+        log_error('Unable to read file: {}'.format(file_path))
+        raise
+
+    # Fastq or fasta reads
+    if first not in ('@', '>'):
+        raise RuntimeError('Unrecognized read file format: {}'.format(
+            file_path))
+
+    return file_path, None
+
 def process_read_files(reads, load=False):
 
     if not isinstance(reads, list):
@@ -258,7 +431,12 @@ def process_read_files(reads, load=False):
 
     to_return = []
     for read in reads:
-        to_return.append(process_seq_file(read, load=load))
+
+        if load:
+            to_return.append(process_seq_file(read, load=load))
+
+        else:
+            to_return.append(process_read_file(read))
 
     return to_return
 
@@ -324,48 +502,144 @@ def fasta_iterator(flname):
     # ACTGACTGACTGACTGACTGACTGACTG\n
     # ACTGACTGACTGACTGACTGACTGACTG\n
     # 
-    # Parse accordingly
+    # The file is read in blocks that are cut at record
+    # boundaries, so the newlines of a record are removed all
+    # at once. Gives the same results as fasta_records
 
-    with open(flname, 'r') as f:
-        # f is an interable
+    with open(flname, 'rb') as f:
 
-        # Stores the sequences
-        sequence_parts = []
+        block = f.read(_FASTA_BLOCK_SIZE)
 
-        # Key for a sequence
-        key = ''
+        # When every sequence is on a single line there is nothing
+        # to join, reading line by line is faster for those. Same
+        # for windows line endings, which need another pass
+        if block.count('\n') <= 2 * (block.count('\n>') + 1) or \
+            '\r' in block:
 
-        for line in f:
+            f.seek(0)
 
-            # Get rid of the newline
-            line = line.strip()
+            for record in fasta_records(f):
+                yield record
 
-            # Empty line
-            if not line:
-                continue
+            return
 
-            if line[0] == '>':
-                if key:
-                    # Start of a new fasta record
-                    # return the previous record
-                    
-                    # join the sequence
-                    full_seqence = ''.join(sequence_parts).upper()
-                    
-                    yield (key, full_seqence)
+        for i, chunk in enumerate(fasta_chunks(f, block)):
 
-                # Start of the file
-                key = line[1:].split()[0]
-                sequence_parts = []
+            for record in fasta_chunk_records(chunk, first=(i == 0)):
+                yield record
 
-            else:
-                sequence_parts.append(line)
+def fasta_chunks(flobj, block):
+    # Pieces of the file cut right before a record starts,
+    # block is whatever has already been read
 
-        if key:
-            # The last sequence in the file
-            full_seqence = ''.join(sequence_parts).upper()
-            
-            yield (key, full_seqence)
+    # The blocks since the start of the last record,
+    # which might not be complete yet
+    parts = []
+
+    while block:
+
+        cut = block.rfind('\n>')
+
+        if cut >= 0:
+            parts.append(block[:cut])
+            yield ''.join(parts)
+            parts = [block[cut+1:]]
+
+        # The record starts right at the beginning
+        # of the block
+        elif block[0] == '>' and parts and parts[-1].endswith('\n'):
+            parts[-1] = parts[-1][:-1]
+            yield ''.join(parts)
+            parts = [block]
+
+        else:
+            parts.append(block)
+
+        block = flobj.read(_FASTA_BLOCK_SIZE)
+
+    yield ''.join(parts)
+
+def fasta_chunk_records(chunk, first=False):
+    # The records in a piece of a fasta file that starts with a
+    # record, or is the start of the file if first is set
+
+    if not chunk:
+        return
+
+    # Whatever is before the first header
+    if first and chunk[0] != '>':
+
+        for record in fasta_records(chunk.split('\n')):
+            yield record
+
+        return
+
+    pieces = chunk.split('\n>')
+
+    # Every chunk starts with a record
+    pieces[0] = pieces[0][1:]
+
+    for piece in pieces:
+
+        header_end = piece.find('\n')
+
+        if header_end < 0:
+            header_end = len(piece)
+
+        sequence = piece[header_end+1:].replace('\n', '')
+
+        # Only plain letters are sure to come out the same as
+        # the line by line parser, anything else goes that way
+        if not sequence.isalpha() and sequence:
+
+            for record in fasta_records(('>' + piece).split('\n')):
+                yield record
+
+            continue
+
+        yield (piece[:header_end].split()[0], sequence.upper())
+
+def fasta_records(lines):
+    # Same as fasta_iterator, for lines that
+    # come from anywhere
+
+    # Stores the sequences
+    sequence_parts = []
+
+    # Key for a sequence
+    key = ''
+
+    for line in lines:
+
+        # Get rid of the newline
+        line = line.strip()
+
+        # Empty line
+        if not line:
+            continue
+
+        if line[0] == '>':
+            if key:
+                # Start of a new fasta record
+                # return the previous record
+                
+                # join the sequence
+                full_seqence = ''.join(sequence_parts).upper()
+                
+                yield (key, full_seqence)
+
+            # Start of the file
+            key = line[1:].split()[0]
+            sequence_parts = []
+
+        else:
+            sequence_parts.append(line)
+
+    if key:
+        # The last sequence in the file
+        full_seqence = ''.join(sequence_parts).upper()
+        
+        yield (key, full_seqence)
 
 def parse_fasta(flname, rename=False):
     
@@ -449,6 +723,20 @@ def check_mismatches(seq1, seq2):
 
     return mismatches
 
+def count_mismatches(pairs):
+    """
+    check_mismatches for a list of (seq1, seq2) pairs, all done
+    at once with numpy if it is available
+    """
+
+    try:
+        from .iupac import count_mismatches as _count_mismatches
+
+    except ImportError:
+        return [check_mismatches(seq1, seq2) for seq1, seq2 in pairs]
+
+    return _count_mismatches(pairs)
+
 # TODO rewrite to fit with code-base
 def parse_paired_files(readFiles):
     """
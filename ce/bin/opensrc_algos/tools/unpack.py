@@ -0,0 +1,365 @@
+###################################################################
+#
+# Unpacks gzipped files in parallel, across files and, for files
+# made of many gzip members (BGZF, concatenated gzips), across
+# the members of a file
+#
+# Author: Milan Patel
+# Contact: mpatel5@cdc.gov
+# Version 1.0
+#
+###################################################################
+
+import os
+import zlib
+import multiprocessing as mp
+
+from .environment import (
+    log_message,
+    log_warning
+)
+
+_READ_SIZE = 1 << 20
+
+# Gzip magic plus the deflate method, where a member can start
+_MEMBER_START = '\x1f\x8b\x08'
+
+# Compressed data looked at to tell if a file has many members
+_PROBE_SIZE = 1 << 22
+
+# Files smaller than this are not worth splitting up
+_MIN_SPLIT_SIZE = 1 << 26
+
+def normalized_copy(blocks, out):
+    # Writes the blocks out with \r\n turned into \n,
+    # even when the two are split between blocks
+    carry = ''
+
+    for block in blocks:
+
+        block = carry + block
+        carry = ''
+
+        if block.endswith('\r'):
+            carry = '\r'
+            block = block[:-1]
+
+        out.write(block.replace('\r\n', '\n'))
+
+    out.write(carry)
+
+def file_blocks(path, size=_READ_SIZE):
+
+    with open(path, 'rb') as f:
+
+        while True:
+
+            block = f.read(size)
+
+            if not block:
+                return
+
+            yield block
+
+def gzip_blocks(path, size=_READ_SIZE):
+    """
+    The decompressed data of a gzipped file, any number of members.
+    zlib straight up is a lot quicker than the gzip module
+    """
+
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    with open(path, 'rb') as f:
+
+        while True:
+
+            data = f.read(size)
+
+            if not data:
+                break
+
+            while data:
+
+                yield inflater.decompress(data)
+
+                data = inflater.unused_data
+
+                if data:
+                    # The next member, the gzip module skips
+                    # zeros padding out the end too
+                    data = data.lstrip('\0')
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    # Same check as inflate_member
+    inflater.decompress('\0')
+
+    if inflater.unused_data != '\0':
+        raise zlib.error('Truncated gzip member')
+
+def inflate_member(f, start, out):
+    """
+    Decompresses the gzip member starting at start into out, returns
+    the offset where it ends. The CRC and length in the trailer
+    are checked by zlib, raises zlib.error if it is not valid.
+    """
+
+    f.seek(start)
+
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    position = start
+
+    while True:
+
+        data = f.read(_READ_SIZE)
+
+        if not data:
+            # Anything after the end of a member is left unused,
+            # a truncated member takes it instead
+            inflater.decompress('\0')
+
+            if inflater.unused_data != '\0':
+                raise zlib.error('Truncated gzip member')
+
+            return position
+
+        position += len(data)
+        out.write(inflater.decompress(data))
+
+        if inflater.unused_data:
+            return position - len(inflater.unused_data)
+
+def inflate_members(f, start, stop, out):
+    # Decompresses member after member for as long as
+    # they start before stop, returns where the last ended
+    position = start
+
+    while position < stop:
+        position = inflate_member(f, position, out)
+
+    return position
+
+def is_multi_member(path):
+    # The file has more than one member if the first
+    # one ends early on
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    with open(path, 'rb') as f:
+        data = f.read(_PROBE_SIZE)
+
+    try:
+        inflater.decompress(data, 1)
+
+        while inflater.unconsumed_tail and not inflater.unused_data:
+            inflater.decompress(inflater.unconsumed_tail, _READ_SIZE)
+
+    except zlib.error:
+        return False
+
+    return bool(inflater.unused_data)
+
+def find_member(f, lo, hi, out):
+    """
+    The first member that starts within [lo, hi) and decompresses
+    cleanly, that one is decompressed into out. Returns the start and
+    end of the member or None if there isn't one
+    """
+
+    position = lo
+
+    while position < hi:
+
+        f.seek(position)
+        window = f.read(min(_READ_SIZE, hi - position) + len(_MEMBER_START) - 1)
+
+        found = window.find(_MEMBER_START)
+
+        if found < 0 or position + found >= hi:
+            position += max(1, len(window) - len(_MEMBER_START) + 1)
+            continue
+
+        start = position + found
+
+        # Reserved flag bits are never set in a real header
+        if len(window) > found + 3 and ord(window[found + 3]) & 0xe0:
+            position = start + 1
+            continue
+
+        try:
+            return start, inflate_member(f, start, out)
+
+        except zlib.error:
+            out.seek(0)
+            out.truncate()
+            position = start + 1
+
+    return None
+
+def _unpack_file(job):
+    # Worker: a whole file, straight to its final path
+    path, out_path = job
+
+    with open(out_path, 'wb') as out:
+        normalized_copy(gzip_blocks(path), out)
+
+    return out_path
+
+def _unpack_range(job):
+    # Worker: the members starting within [lo, hi) into a part file
+    path, lo, hi, part_path = job
+
+    with open(path, 'rb') as f, open(part_path, 'wb') as out:
+
+        member = find_member(f, lo, hi, out)
+
+        if member is None:
+            return None
+
+        start, end = member
+
+        try:
+            return start, inflate_members(f, end, hi, out)
+
+        except zlib.error:
+            # Left for the whole file to be unpacked again
+            return start, None
+
+def split_jobs(path, out_path, pieces):
+    # The byte ranges of a file for the workers to start from
+    size = os.path.getsize(path)
+    step = -(-size // pieces)
+
+    return [(path, lo, min(size, lo + step), '{}.part{}'.format(out_path, i)) \
+        for i, lo in enumerate(xrange(0, size, step))]
+
+def fill_gap(f, start, stop, gap_path):
+    # The members that no worker found, ones too long to start
+    # within the range of the worker that was looking for them
+    with open(gap_path, 'wb') as out:
+        end = inflate_members(f, start, stop, out)
+
+    if end != stop:
+        raise zlib.error('Gzip members do not line up')
+
+    return gap_path
+
+def join_parts(path, out_path, jobs, ranges):
+    """
+    Puts the parts decompressed by the workers together. The members
+    of a part have to pick up exactly where the last part stopped,
+    any gaps are filled in here. Raises zlib.error if the parts
+    don't fit together.
+    """
+
+    parts = []
+    position = 0
+
+    with open(path, 'rb') as f:
+
+        for (_, _, _, part_path), member_range in zip(jobs, ranges):
+
+            if member_range is None:
+                continue
+
+            start, end = member_range
+
+            if end is None:
+                raise zlib.error('Bad gzip member')
+
+            if start != position:
+                parts.append(fill_gap(f, position, start, part_path + '.gap'))
+
+            parts.append(part_path)
+            position = end
+
+        size = os.path.getsize(path)
+
+        if position != size:
+            parts.append(fill_gap(f, position, size, out_path + '.gap'))
+
+    with open(out_path, 'wb') as out:
+        normalized_copy((block for part in parts for \
+            block in file_blocks(part)), out)
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def unpack_files(jobs, threads=1):
+    """
+    Unpacks the gzipped files in jobs, a list of (path, out_path),
+    with the line endings normalized on the way. Up to threads processes
+    are used: files are unpacked side by side, and big files with
+    many members (BGZF, concatenated gzips) are split up between
+    the processes too
+    """
+
+    if not jobs:
+        return
+
+    threads = max(1, threads)
+
+    whole_jobs = []
+    split_files = []
+
+    for path, out_path in jobs:
+
+        if threads > 1 and os.path.getsize(path) >= _MIN_SPLIT_SIZE \
+            and is_multi_member(path):
+
+            log_message('Unpacking {} in blocks...'.format(
+                os.path.basename(path)))
+
+            split_files.append((path, out_path, split_jobs(
+                path, out_path, threads)))
+
+        else:
+            log_message('Unpacking {}...'.format(os.path.basename(path)))
+            whole_jobs.append((path, out_path))
+
+    range_jobs = [job for _, _, file_jobs in split_files for job in file_jobs]
+
+    # Everything the workers write besides the final files
+    temp_paths = [part_path + ext for _, _, _, part_path in range_jobs \
+        for ext in ('', '.gap')] + [out_path + '.gap' for _, out_path, _ \
+        in split_files]
+
+    try:
+        ranges = []
+
+        if threads > 1 and len(whole_jobs) + len(range_jobs) > 1:
+
+            pool = mp.Pool(min(threads, len(whole_jobs) + len(range_jobs)))
+
+            try:
+                # The ranges go first, they are the most even
+                range_results = pool.map_async(_unpack_range, range_jobs)
+                whole_results = pool.map_async(_unpack_file, whole_jobs)
+
+                ranges = range_results.get()
+                whole_results.get()
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            ranges = map(_unpack_range, range_jobs)
+            map(_unpack_file, whole_jobs)
+
+        for path, out_path, file_jobs in split_files:
+
+            file_ranges = ranges[:len(file_jobs)]
+            ranges = ranges[len(file_jobs):]
+
+            try:
+                join_parts(path, out_path, file_jobs, file_ranges)
+
+            except zlib.error as e:
+                log_warning('Unable to unpack {} in blocks: {}, unpacking it'
+                    ' whole'.format(os.path.basename(path), str(e)))
+
+                _unpack_file((path, out_path))
+
+    finally:
+        remove_files(temp_paths)